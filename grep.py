@@ -1,37 +1,88 @@
 #!/home/joshua/.pyenv/versions/3.6.1/bin/python3.6
 import sys
 import os
+import io
+import stat
+import functools
+import itertools
+import collections
+from concurrent import futures
 
 import thinap
-from lib import (open_file, GrepWorker, GrepWorkerAgg, GrepWorkerFileName,
-                 GrepWorkerContext, recursive_walk, walk)
+from lib import (human_size_to_byte, open_file, is_binary,
+                 GrepWorker, GrepWorkerAgg, GrepStatusDetermined,
+                 GrepWorkerFileName, GrepWorkerContext, GrepWorkerBinary,
+                 GrepWorkerOnlyMatching, MemoryFile, read_small_file,
+                 recursive_walk, walk, make_pool_processor,
+                 make_async_processor, ResultCache, SpillBuffer, split_file,
+                 count_newlines)
 
 
 class Grep:
 
+    # the largest file read ahead whole for the --async-reads option
+    async_read_limit = 1 << 16
+
+    # the total size of the outputs kept by the --cache option
+    cache_size = 64 << 20
+
+    # a file is searched in segments of this size or smaller by the -j
+    # option, as many as the jobs if it is large enough to have that
+    # many of the smallest size.
+    segment_min = 8 << 20
+    segment_max = 64 << 20
+
     def __init__(self, orig_cmd=None, cmd_name=None,
                  bs=None, output_file=None):
         self.orig_cmd = orig_cmd or '/bin/grep'
         self.cmd_name = cmd_name or 'grep'
-        self.bs = bs or 8192
+        self.bs = bs or 1048576
         self.ofile = output_file or os.fdopen(sys.stdout.fileno(), 'wb')
+        self.cache = None
 
     def parse_args(self, args):
         request = {'ignore_case': {'flag': ['-i', '--ignore-case']},
                    'file_match': {'flag': ['-l', '--files-with-matches']},
+                   'files_without_match': {'flag': ['-L',
+                                            '--files-without-match']},
                    'line_number': {'flag': ['-n', '--line-number']},
+                   'byte_offset': {'flag': ['-b', '--byte-offset']},
                    'count': {'flag': ['-c', '--count']},
                    'only_matching': {'flag': ['-o', '--only-matching']},
                    'word_regexp': {'flag': ['-w', '--word-regexp']},
+                   'fixed_strings': {'flag': ['-F', '--fixed-strings']},
+                   'regexp': {'flag': ['-e', '--regexp'], 'arg': 1,
+                              'multi': True},
+                   'pattern_file': {'flag': ['-f', '--file'], 'arg': 1,
+                                    'multi': True},
+                   'max_count': {'flag': ['-m', '--max-count'], 'arg': 1},
                    'after': {'flag': ['-A', '--after-context'], 'arg': 1},
                    'before': {'flag': ['-B', '--before-context'], 'arg': 1},
                    'context': {'flag': ['-C', '--context'], 'arg': 1},
+                   'recursive': {'flag': ['-r', '--recursive']},
                    'drecursive': {'flag': ['-R', '--dereference-recursive']},
+                   'skip_duplicates': {'flag': '--skip-duplicates'},
+                   'include': {'flag': '--include', 'arg': 1, 'multi': True},
+                   'exclude': {'flag': '--exclude', 'arg': 1, 'multi': True},
+                   'exclude_dir': {'flag': '--exclude-dir', 'arg': 1,
+                                   'multi': True},
+                   'gitignore': {'flag': '--gitignore'},
+                   'index': {'flag': '--index', 'arg': 1},
+                   'decompress': {'flag': '--decompress'},
+                   'binary_files': {'flag': '--binary-files', 'arg': 1},
+                   'binary_without_match': {'flag': '-I'},
+                   'text': {'flag': ['-a', '--text']},
                    'quiet': {'flag': ['-q', '--quiet', '--silent']},
                    'invert': {'flag': ['-v', '--invert-match']},
                    'with_filename': {'flag': '-H', 'multi': True, 'order': True},
                    'no_filename': {'flag': '-h', 'multi': True, 'order': True},
                    'color': {'flag': ['--color', '--colour'], 'arg': 3},
+                   'jobs': {'flag': ['-j', '--jobs'], 'arg': 1},
+                   'keep_order': {'flag': '--keep-order'},
+                   'json': {'flag': '--json'},
+                   'cache': {'flag': '--cache', 'arg': 1},
+                   'cache_size': {'flag': '--cache-size', 'arg': 1},
+                   'async_reads': {'flag': '--async-reads', 'arg': 1},
         }
         p = thinap.ArgParser()
         return p.parse_args(args, request, preserve=True)
@@ -48,19 +99,63 @@ class Grep:
 
         pattern, files, options = self.comprehend_params(params)
 
+        # -m 0 stops before reading anything
+        if options.get('max_count') == 0:
+            return False
+
         # when no file specified for reading, use stdin.
         if not files:
             files = ['-']
 
+        # replay the output of the unchanged files for the --cache
+        # option, the output kept must not depend on the terminal.
+        if 'cache' in options:
+            if options['color'] == 'auto':
+                options['color'] = 'always' if self.ofile.isatty() else 'never'
+            self.cache = self.open_cache(options)
+
+        # send the files to a pool of processes for the -j option,
+        # the workers in the pool write to memory, not a terminal.
+        # Each process opens the cache of the --cache option as well.
+        processor = None
+        if options.get('jobs', 1) > 1:
+            if options['color'] == 'auto':
+                options['color'] = 'always' if self.ofile.isatty() else 'never'
+            pool_worker = functools.partial(pool_work, self.bs)
+            processor = make_pool_processor(options['jobs'], pool_worker,
+                                            self.ofile, 'keep_order' in options,
+                                            self.split, self.search_segments)
+
+        # read the files ahead in threads for the --async-reads option,
+        # the small ones are searched in memory.
+        elif 'async_reads' in options:
+            reader = functools.partial(read_small_file,
+                                       limit=self.async_read_limit,
+                                       decompress='decompress' in options)
+            if self.cache:
+                reader = functools.partial(self.read_keyed, reader,
+                                           pattern, options)
+            processor = make_async_processor(options['async_reads'],
+                                             self.work_buffer, reader)
+
         # work on each file
-        if 'drecursive' in options:
-            status = recursive_walk(self.work, files, pattern, options)
-        else:
-            status = walk(self.work, files, pattern, options)
+        try:
+            if 'recursive' in options or 'drecursive' in options:
+                status = recursive_walk(self.work, files, pattern, options,
+                                        processor)
+            else:
+                status = walk(self.work, files, pattern, options, processor)
+        finally:
+            if self.cache:
+                self.cache.close()
 
         self.ofile.close()
         return status
 
+    def open_cache(self, options):
+        return ResultCache(options['cache'],
+                           options.get('cache_size', self.cache_size))
+
     def comprehend_params(self, params):
         """AssertionError will be raised for wrong argument"""
         options = params[0]
@@ -82,14 +177,23 @@ class Grep:
         if after is not None:
             options['after'] = after
 
+        # patterns given by -e and -f leave all
+        # the non-option arguments to be files.
         x = params[1]
-        assert x, "pattern is required"
-        pattern = x[0]
-        files = x[1:]
+        if 'regexp' in options or 'pattern_file' in options:
+            pattern = options.get('regexp', [])[:]
+            for name in options.get('pattern_file', []):
+                pattern.extend(self.read_patterns(name))
+            files = x
+        else:
+            assert x, "pattern is required"
+            pattern = x[0][-1]
+            files = x[1:]
 
         # show the file name or not?
         with_filename = False
-        if 'drecursive' in options or len(files) > 1:
+        if ('recursive' in options or 'drecursive' in options or
+                len(files) > 1):
             with_filename = True
         # if both -h and -H are supplied, the right-most takes effect.
         if 'with_filename' in options and 'no_filename' in options:
@@ -113,30 +217,296 @@ class Grep:
         color_valid = color in ('never', 'always', 'auto')
         assert color_valid, "invalid argument for --color: %s" % color
 
+        # the records of --json are for programs, they hold lines only
+        if 'json' in options:
+            conflicts = set(['only_matching', 'count', 'file_match',
+                             'files_without_match']) & set(options)
+            assert not conflicts, "--json can not be used with -o, -c, -l or -L"
+            options['color'] = 'never'
+
+        # how to treat binary files?
+        binary_files = options.get('binary_files', 'binary')
+        if 'text' in options:
+            binary_files = 'text'
+        if 'binary_without_match' in options:
+            binary_files = 'without-match'
+        binary_valid = binary_files in ('binary', 'without-match', 'text')
+        assert binary_valid, "invalid argument for --binary-files: %s" % (
+                binary_files)
+        options['binary_files'] = binary_files
+
+        if 'max_count' in options:
+            v = options['max_count']
+            assert v.isdigit(), "invalid argument for -m: %s" % v
+            options['max_count'] = int(v)
+
+        if 'jobs' in options:
+            v = options['jobs']
+            assert v.isdigit() and int(v), "invalid argument for -j: %s" % v
+            options['jobs'] = int(v)
+
+        if 'cache_size' in options:
+            options['cache_size'] = human_size_to_byte(options['cache_size'])
+
+        if 'async_reads' in options:
+            v = options['async_reads']
+            assert v.isdigit() and int(v), (
+                    "invalid argument for --async-reads: %s" % v)
+            options['async_reads'] = int(v)
+
         # remove the argument position info
-        pattern = pattern[-1]
         files = [a for n,a in files]
         return pattern, files, options
 
+    def read_patterns(self, name):
+        """Read patterns from a file, one per line"""
+        if name == '-':
+            return sys.stdin.read().splitlines()
+        with open(name) as f:
+            return f.read().splitlines()
+
     def work(self, file, pattern, options):
+        if self.cache and file != '-':
+            key = self.cache.key(file, pattern, options)
+            if key:
+                return self.work_cached(file, key, pattern, options)
         try:
-            ifile = open_file(file)
+            ifile = open_file(file, 'decompress' in options)
         except Exception as e:
             print(str(e), file=sys.stderr)
             return False
+        status = self.search(ifile, pattern, options)
+        ifile.close()
+        return status
 
+    def work_cached(self, file, key, pattern, options, ifile=None):
+        """Replay the status and the output of the file kept in the
+        cache under key, or search the file and keep them. A file that
+        changes while it is searched is not kept, nor is a failure to
+        open, nor an output that outgrows the cache, which is written
+        out as it comes once it does. The file is opened unless ifile
+        holds its data read ahead.
+        """
+        found = self.cache.get(key)
+        if found:
+            status, data = found
+            self.ofile.write(data)
+        else:
+            try:
+                ifile = ifile or open_file(file, 'decompress' in options)
+            except Exception as e:
+                print(str(e), file=sys.stderr)
+                return False
+            ofile = SpillBuffer(self.ofile, self.cache.limit)
+            try:
+                status = Grep(bs=self.bs, output_file=ofile).search(
+                        ifile, pattern, options)
+            except GrepStatusDetermined:
+                status = True
+            finally:
+                ifile.close()
+            if not ofile.spilled:
+                data = ofile.getvalue()
+                self.ofile.write(data)
+                if self.cache.key(file, pattern, options) == key:
+                    self.cache.put(key, status, data)
+        if status and 'quiet' in options:
+            raise GrepStatusDetermined
+        return status
+
+    def work_buffer(self, file, data, pattern, options):
+        """Work on the data of the file read ahead, which comes with
+        the key of the file in the cache for the --cache option.
+        """
+        if self.cache:
+            key, data = data
+            if key:
+                return self.work_cached(file, key, pattern, options,
+                                        MemoryFile(file, data))
+        return self.search(MemoryFile(file, data), pattern, options)
+
+    def read_keyed(self, reader, pattern, options, file):
+        """Read the file ahead by reader along with its key in the
+        cache, made first, so the data is no older than the key.
+        """
+        key = self.cache.key(file, pattern, options)
+        data = reader(file)
+        return None if data is None else (key, data)
+
+    def split(self, name, options):
+        """Return the segments of a large regular file for the -j
+        option, None for a file to be searched whole. The context
+        of a line may lie in another segment, so the context options
+        keep a file whole, as does a binary file, whose search stops
+        at the first match anyway.
+        """
+        if name == '-' or set(['after', 'before', 'context']) & set(options):
+            return None
+        try:
+            st = os.stat(name)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size < self.segment_min * 2:
+            return None
+        # a file the cache may keep is searched whole, for its output
+        if self.cache and st.st_size <= self.cache.limit:
+            return None
+        try:
+            ifile = open_file(name, 'decompress' in options)
+        except OSError:
+            return None
+        try:
+            if not isinstance(ifile, io.BufferedReader):
+                return None
+            if options['binary_files'] != 'text' and is_binary(ifile):
+                return None
+        finally:
+            ifile.close()
+        count = max(options['jobs'], -(-st.st_size // self.segment_max))
+        count = min(count, st.st_size // self.segment_min)
+        segments = split_file(name, count)
+        return segments if len(segments) > 1 else None
+
+    def search_segments(self, pool, name, segments, pattern, options):
+        """Search the segments of the file in the pool, a bounded
+        number of them in flight. The output is written in the order
+        of the segments. The line numbers of a segment count on from
+        the newlines before it, counted first in the pool as well.
+
+        For -q, -l and -L, the first segment that has a selected line
+        decides, the rest are cancelled. For -c, the counts are added
+        up. For -m, the segments are cancelled once the limit is
+        reached, the segment where it is reached is searched again
+        here for the lines it lacks.
+        """
+        bases = [0] * len(segments)
+        if ('line_number' in options or 'json' in options) and not set(
+                ['count', 'file_match', 'files_without_match',
+                 'quiet']) & set(options):
+            starts, stops = zip(*segments)
+            counts = pool.map(count_newlines, itertools.repeat(name),
+                              starts, stops)
+            bases = list(itertools.accumulate(itertools.chain([0], counts)))
+
+        # the binary test is made once for the whole file
+        options = dict(options, binary_files='text')
+        decisive = set(['quiet', 'file_match',
+                        'files_without_match']) & set(options)
+        limit = options.get('max_count')
+        todo = zip(segments, bases)
+        flight = options['jobs'] * 2
+        pending = collections.deque()
+        status = False
+        total = 0
+        last = b''
+        try:
+            while True:
+                for (start, stop), base in itertools.islice(
+                        todo, flight - len(pending)):
+                    future = pool.submit(segment_work, self.bs, name, start,
+                                         stop, base, pattern, options)
+                    pending.append((future, start, stop, base))
+                if not pending:
+                    break
+                if decisive:
+                    done, _ = futures.wait([x[0] for x in pending],
+                                           return_when=futures.FIRST_COMPLETED)
+                    for item in [x for x in pending if x[0] in done]:
+                        pending.remove(item)
+                        found, last, count = item[0].result()
+                        if not found:
+                            continue
+                        if 'quiet' in options:
+                            raise GrepStatusDetermined
+                        if 'file_match' in options:
+                            self.ofile.write(last)
+                        return True
+                    continue
+                future, start, stop, base = pending.popleft()
+                found, data, count = future.result()
+                if 'count' in options:
+                    # the output is the count, after the file name
+                    last = data[:len(data) - len(b'%d\n' % count)]
+                    if limit is not None:
+                        count = min(count, limit - total)
+                elif limit is not None and count > limit - total:
+                    found, data, count = segment_work(
+                            self.bs, name, start, stop, base, pattern,
+                            dict(options, max_count=limit - total))
+                status = status or found
+                total += count
+                if 'count' not in options:
+                    self.ofile.write(data)
+                if total == limit:
+                    break
+        finally:
+            for future, *_ in pending:
+                future.cancel()
+        if 'count' in options:
+            self.ofile.write(last + b'%d\n' % total)
+        elif 'files_without_match' in options:
+            self.ofile.write(last)
+        return status
+
+    def make_worker(self, ifile, pattern, options):
         if 'count' in options:
             worker = GrepWorkerAgg
-        elif 'file_match' in options:
+        elif 'file_match' in options or 'files_without_match' in options:
             worker = GrepWorkerFileName
+        elif options['binary_files'] == 'binary' and is_binary(ifile):
+            worker = GrepWorkerBinary
         elif set(['after', 'before', 'context']) & set(options.keys()):
             worker = GrepWorkerContext
+        elif 'only_matching' in options and 'invert' not in options:
+            worker = GrepWorkerOnlyMatching
         else:
             worker = GrepWorker
-        status = worker(pattern, options, ifile, self.ofile, self.bs).run()
+        return worker(pattern, options, ifile, self.ofile, self.bs)
 
+    def search(self, ifile, pattern, options):
+        return self.make_worker(ifile, pattern, options).run()
+
+
+def pool_work(bs, files, pattern, options):
+    """Work in a process of the pool, return the statuses and
+    the output of the files.
+    """
+    ofile = io.BytesIO()
+    app = Grep(bs=bs, output_file=ofile)
+    if 'cache' in options:
+        app.cache = app.open_cache(options)
+    try:
+        status_list = [app.work(file, pattern, options) for file in files]
+    finally:
+        if app.cache:
+            app.cache.close()
+    return status_list, ofile.getvalue()
+
+
+def segment_work(bs, file, start, stop, base, pattern, options):
+    """Search the lines of the file in [start, stop) in a process of
+    the pool, base lines come before them. Return the status, the
+    output, and the number of lines selected, or counted for -c.
+    """
+    ofile = io.BytesIO()
+    try:
+        ifile = open_file(file)
+    except OSError as e:
+        print(str(e), file=sys.stderr)
+        return False, b'', 0
+    try:
+        ifile.seek(start)
+        worker = Grep(bs=bs, output_file=ofile).make_worker(
+                ifile, pattern, options)
+        worker.stop = stop
+        worker.nr = base
+        status = worker.run()
+    except GrepStatusDetermined:
+        status = True
+    finally:
         ifile.close()
-        return status
+    count = getattr(worker, 'match_count', worker.selected)
+    return status, ofile.getvalue(), count
 
 
 if __name__ == '__main__':
@@ -1,6 +1,26 @@
 import sys
 import os
 import re
+import bz2
+import gzip
+import lzma
+import io
+import json
+import base64
+import stat
+import time
+import hashlib
+import sqlite3
+import fnmatch
+import operator
+import functools
+import itertools
+import collections
+from concurrent import futures
+try:
+    from re import _parser as sre_parse
+except ImportError:     # before Python 3.11
+    import sre_parse
 
 
 def human_size_to_byte(number):
@@ -70,11 +90,132 @@ def correct_offset(file):
     file.seek(cur)
 
 
-def open_file(file):
+def open_file(file, decompress=False):
+    """Open a file for reading bytes, '-' for the standard input.
+    With decompress, a file compressed by gzip, bzip2 or xz is
+    read as its decompressed data.
+    """
     if file == '-':
-        return os.fdopen(sys.stdin.fileno(), 'rb')
+        f = os.fdopen(sys.stdin.fileno(), 'rb')
+    else:
+        f = open(file, 'rb')
+    if decompress and not f.isatty():
+        f = open_compressed(f)
+    return f
+
+
+# magic bytes of the compressed formats, and the modules reading them
+compressors = [(b'\x1f\x8b', gzip), (b'BZh', bz2), (b'\xfd7zXZ\x00', lzma)]
+
+
+def open_compressed(file):
+    """Tell the format by the magic bytes at the head of the file,
+    a file in none of the formats is returned as it is.
+    """
+    head = file.peek(6)
+    for magic, module in compressors:
+        if head.startswith(magic):
+            return CompressedFile(file, module)
+    return file
+
+
+class CompressedFile:
+
+    """A compressed file read as its decompressed data. It is not a
+    regular file to the workers, it is neither read by windows nor
+    seeked.
+    Closing it closes the underlying file as well.
+    """
+
+    def __init__(self, file, module):
+        self.file = file
+        self.name = file.name
+        self.stream = module.open(file, 'rb')
+        self.read = self.stream.read
+        self.readline = self.stream.readline
+        self.peek = self.stream.peek
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        self.stream.close()
+        self.file.close()
+
+
+class MemoryFile(io.BytesIO):
+
+    """The data of a file read ahead into memory, searched in place of
+    the file. It is not a regular file to the workers, it is never
+    read by windows.
+    """
+
+    def __init__(self, name, data):
+        super(MemoryFile, self).__init__(data)
+        self.name = name
+
+    def peek(self, size=1):
+        pos = self.tell()
+        return self.getbuffer()[pos:pos + size].tobytes()
+
+
+def read_small_file(file, limit, decompress=False):
+    """Read the whole data of a file, None if there is more than limit
+    bytes of it. A plain file is read by its descriptor, without the
+    buffered file object around it.
+    """
+    if decompress:
+        f = open_file(file, decompress)
+        try:
+            data = f.read(limit + 1)
+        finally:
+            f.close()
+        return data if len(data) <= limit else None
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        parts = []
+        size = 0
+        while size <= limit:
+            part = os.read(fd, limit + 1 - size)
+            if not part:
+                break
+            parts.append(part)
+            size += len(part)
+    finally:
+        os.close(fd)
+    return b''.join(parts) if size <= limit else None
+
+
+def is_binary(file):
+    """Tell if the file holds binary data, the first block is sniffed
+    for a NUL byte as GNU grep does. The block is peeked, the file
+    offset is left untouched. A terminal is never binary.
+    """
+    if file.isatty() or not hasattr(file, 'peek'):
+        return False
+    return b'\0' in file.peek(8192)
+
+
+# the bytes other than b'\n' at which bytes.splitlines breaks a line
+line_breaks = (b'\r', b'\v', b'\f', b'\x1c', b'\x1d', b'\x1e')
+
+
+def split_lines(data):
+    """Split data into lines at b'\n' alone, each keeps its newline.
+    bytes.splitlines breaks at a few control characters as well, it
+    is far faster though, and used when there are none of them.
+    """
+    for x in line_breaks:
+        if x in data:
+            break
     else:
-        return open(file, 'rb')
+        return data.splitlines(True)
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [x + b'\n' for x in lines]
+    if last:
+        lines.append(last)
+    return lines
 
 
 class Locator:
@@ -521,6 +662,431 @@ class TailWorkerTB(TailWorkerTL):
 
 class GrepNameDetermined(Exception): pass
 class GrepStatusDetermined(Exception): pass
+class GrepMaxCountReached(Exception): pass
+
+
+class Match:
+
+    """A minimal stand-in for the re match object, for the patterns
+    that are not backed by the re module.
+    """
+
+    __slots__ = ('string', 'pos', 'endpos')
+
+    def __init__(self, string, pos, endpos):
+        self.string = string
+        self.pos = pos
+        self.endpos = endpos
+
+    def start(self):
+        return self.pos
+
+    def end(self):
+        return self.endpos
+
+    def span(self):
+        return self.pos, self.endpos
+
+    def group(self, n=0):
+        assert n == 0, "no such group: %s" % n
+        return self.string[self.pos:self.endpos]
+
+
+class LinePattern:
+
+    """Wrap a compiled pattern whose meaning depends on the boundary
+    of the string (\\A, \\Z, lookaround), or that may match a newline,
+    so that a chunk is searched one line at a time, exactly as if each
+    line were a string without its newline, as GNU grep sees a line.
+    The re module takes endpos as the end of the string, a line that
+    starts the buffer is searched in place.
+    """
+
+    def __init__(self, pat):
+        self.pat = pat
+
+    def search(self, buf, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(buf)
+        search = self.pat.search
+        while pos < endpos:
+            end = buf.find(b'\n', pos, endpos)
+            if end < 0:
+                end = endpos
+            m = search(buf[pos:end]) if pos else search(buf, 0, end)
+            if m:
+                return Match(buf, pos + m.start(), pos + m.end())
+            pos = end + 1
+        return None
+
+    def finditer(self, buf, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(buf)
+        finditer = self.pat.finditer
+        while pos < endpos:
+            end = buf.find(b'\n', pos, endpos)
+            if end < 0:
+                end = endpos
+            found = finditer(buf[pos:end]) if pos else finditer(buf, 0, end)
+            for m in found:
+                yield Match(buf, pos + m.start(), pos + m.end())
+            pos = end + 1
+
+    def findall(self, buf, pos=0, endpos=None):
+        return [m.group() for m in self.finditer(buf, pos, endpos)]
+
+
+class BytesPattern:
+
+    """Base of the patterns that are not backed by the re module, they
+    offer the methods of a compiled pattern that the matchers rely on.
+    A subclass defines search, the rest are built on it.
+    Case is ignored by lowercasing both the pattern and the string,
+    which is what the re module does for a bytes pattern as well.
+    """
+
+    # bytes that \\b regards as part of a word in a bytes pattern
+    word_chars = frozenset(b'0123456789_'
+                           b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                           b'abcdefghijklmnopqrstuvwxyz')
+
+    ignore_case = False
+    word_regexp = False
+    src = folded = None
+
+    def fold(self, string):
+        """Return the string for searching, lowercased for the -i
+        option. A chunk is searched many times, so the result for
+        the last string is kept.
+        """
+        if not self.ignore_case:
+            return string
+        if string is not self.src:
+            self.src, self.folded = string, string.lower()
+        return self.folded
+
+    def is_boundary(self, string, pos, endpos):
+        """Behave as \\b does at the position pos"""
+        word = self.word_chars
+        before = pos > 0 and string[pos-1] in word
+        after = pos < endpos and string[pos] in word
+        return before != after
+
+    def is_word(self, string, start, end, endpos):
+        """Tell if string[start:end] satisfies the -w option"""
+        return (self.is_boundary(string, start, endpos) and
+                self.is_boundary(string, end, endpos))
+
+    def finditer(self, string, pos=0, endpos=None):
+        """The matches found by search one after another, the next
+        search starts a byte past an empty match.
+        """
+        if endpos is None:
+            endpos = len(string)
+        while pos <= endpos:
+            m = self.search(string, pos, endpos)
+            if not m:
+                return
+            yield m
+            pos = m.end() if m.end() > m.start() else m.end() + 1
+
+    def findall(self, string, pos=0, endpos=None):
+        return [m.group() for m in self.finditer(string, pos, endpos)]
+
+    def sub(self, repl, string):
+        parts = []
+        last = 0
+        for m in self.finditer(string):
+            parts.append(string[last:m.start()])
+            parts.append(repl(m))
+            last = m.end()
+        parts.append(string[last:])
+        return b''.join(parts)
+
+
+class LiteralPattern(BytesPattern):
+
+    """A fixed string searched with bytes.find"""
+
+    def __init__(self, literal, ignore_case=False, word_regexp=False):
+        assert literal, "empty literal"
+        self.pattern = literal
+        self.ignore_case = ignore_case
+        self.word_regexp = word_regexp
+        self.literal = literal.lower() if ignore_case else literal
+
+    def find(self, string, pos, endpos):
+        """Return the offset of the next occurrence, -1 if none"""
+        string = self.fold(string)
+        literal = self.literal
+        idx = string.find(literal, pos, endpos)
+        if self.word_regexp:
+            size = len(literal)
+            while idx >= 0 and not self.is_word(string, idx,
+                                                idx + size, endpos):
+                idx = string.find(literal, idx + 1, endpos)
+        return idx
+
+    def search(self, string, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(string)
+        idx = self.find(string, pos, endpos)
+        if idx < 0:
+            return None
+        return Match(string, idx, idx + len(self.literal))
+
+    def finditer(self, string, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(string)
+        size = len(self.literal)
+        idx = self.find(string, pos, endpos)
+        while idx >= 0:
+            yield Match(string, idx, idx + size)
+            idx = self.find(string, idx + size, endpos)
+
+    def findall(self, string, pos=0, endpos=None):
+        literal = self.literal
+        if not self.ignore_case and not self.word_regexp:
+            return [literal] * string.count(literal, pos, endpos)
+        if endpos is None:
+            endpos = len(string)
+        find = self.find
+        size = len(literal)
+        found = []
+        idx = find(string, pos, endpos)
+        while idx >= 0:
+            found.append(string[idx:idx + size])
+            idx = find(string, idx + size, endpos)
+        return found
+
+
+class AhoCorasick(BytesPattern):
+
+    """Search a large set of fixed strings in one pass over the data.
+
+    The automaton is kept as a list of transition dicts, one for each
+    state, the transitions of a state include the ones inherited from
+    its failure states, except those of the root state, which are
+    looked up separately. A transition missing from both leads back
+    to the root state.
+    """
+
+    def __init__(self, literals, ignore_case=False, word_regexp=False):
+        assert literals, "no literal"
+        self.ignore_case = ignore_case
+        self.word_regexp = word_regexp
+        if ignore_case:
+            literals = [x.lower() for x in literals]
+
+        # build the trie, 'out' holds the lengths of
+        # the literals ending at each state.
+        goto = [{}]
+        out = [()]
+        for literal in set(literals):
+            state = 0
+            for c in literal:
+                nxt = goto[state].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][c] = nxt
+                    goto.append({})
+                    out.append(())
+                state = nxt
+            out[state] = (len(literal),)
+
+        # breadth first, add the failure transitions
+        root = goto[0]
+        fail = [0] * len(goto)
+        delta = [{}] * len(goto)
+        queue = collections.deque(root.values())
+        while queue:
+            state = queue.popleft()
+            f = fail[state]
+            out[state] += out[f]
+            delta[state] = dict(delta[f])
+            delta[state].update(goto[state])
+            for c, nxt in goto[state].items():
+                fail[nxt] = delta[f].get(c) or root.get(c, 0)
+                queue.append(nxt)
+
+        self.root = root
+        self.delta = delta
+        self.out = out
+
+        # bytes that may start a literal, the scan
+        # skips quickly to them from the root state.
+        starts = b''.join(re.escape(bytes([c])) for c in sorted(root))
+        self.starts = re.compile(b'[' + starts + b']')
+
+    def candidates(self, string, pos, endpos):
+        """Generate the (start, end) of every occurrence, in the
+        order of the end position, overlapping ones included.
+        """
+        folded = self.fold(string)
+        skip = self.starts.search
+        root = self.root.get
+        delta = self.delta
+        out = self.out
+        word = self.word_regexp
+        state = 0
+        idx = pos
+        while idx < endpos:
+            if not state:
+                m = skip(folded, idx, endpos)
+                if not m:
+                    return
+                idx = m.start()
+            c = folded[idx]
+            state = delta[state].get(c) or root(c, 0)
+            idx += 1
+            for size in out[state]:
+                start = idx - size
+                if start < pos:
+                    continue
+                if word and not self.is_word(folded, start, idx, endpos):
+                    continue
+                yield start, idx
+
+    def search(self, string, pos=0, endpos=None):
+        """Return the occurrence that ends first, any occurrence will
+        tell that a line matches.
+        """
+        if endpos is None:
+            endpos = len(string)
+        for start, end in self.candidates(string, pos, endpos):
+            return Match(string, start, end)
+        return None
+
+    def finditer(self, string, pos=0, endpos=None):
+        """The leftmost longest occurrences that do not overlap"""
+        if endpos is None:
+            endpos = len(string)
+        found = sorted(self.candidates(string, pos, endpos),
+                       key=lambda x: (x[0], -x[1]))
+        last = pos
+        for start, end in found:
+            if start >= last:
+                yield Match(string, start, end)
+                last = end
+
+
+class PatternSet(BytesPattern):
+
+    """A group of patterns, a match of any of them is a match of the
+    set. The next match of each pattern in the last searched string is
+    remembered, since a chunk is searched forward many times.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.found = []
+
+    def search(self, string, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(string)
+        if string is not self.src or len(self.found) != len(self.patterns):
+            self.src = string
+            self.found = [(endpos, -1, None)] * len(self.patterns)
+
+        best = None
+        for idx, pat in enumerate(self.patterns):
+            frm, end, m = self.found[idx]
+            if frm > pos or end != endpos or m and m.start() < pos:
+                m = pat.search(string, pos, endpos)
+                self.found[idx] = (pos, endpos, m)
+            if m and (best is None or m.start() < best.start()):
+                best = m
+        return best
+
+    def finditer(self, string, pos=0, endpos=None):
+        """The leftmost longest matches that do not overlap"""
+        if endpos is None:
+            endpos = len(string)
+        found = [m for pat in self.patterns
+                   for m in pat.finditer(string, pos, endpos)]
+        found.sort(key=lambda m: (m.start(), -m.end()))
+        last = pos
+        for m in found:
+            if m.start() >= last:
+                yield m
+                last = max(m.end(), m.start() + 1)
+
+
+class Prefilter(BytesPattern):
+
+    """A pattern searched only on the lines holding one of the strings
+    its matches require, one string for each alternative of the
+    pattern. The strings are found by bytes.find, far faster than the
+    pattern itself. For ignore_case, they are found in a lowercased
+    copy. The next occurrence of each string in the last searched
+    string is remembered, since a chunk is searched forward many times.
+
+    A string found on many lines that do not match is no filter at
+    all, the rest of the chunk is then left to the pattern alone.
+    """
+
+    # lines holding a string but no match, before the filter is judged
+    misses_judged = 64
+
+    # bytes per such line, below which the filter is given up
+    miss_gap = 1024
+
+    def __init__(self, pat, literals, ignore_case=False):
+        self.pat = pat
+        self.literals = literals
+        self.ignore_case = ignore_case
+        self.last = None
+        self.found = []
+
+    def search(self, string, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(string)
+        if string is not self.last or endpos != self.last_end:
+            self.last, self.last_end = string, endpos
+            self.found = [(endpos, -1)] * len(self.literals)
+            self.first, self.misses = pos, 0
+        search = self.pat.search
+        if self.misses is None:
+            return search(string, pos, endpos)
+
+        folded = self.fold(string)
+        found = self.found
+        while pos < endpos:
+            # the first occurrence of any of the strings
+            idx = -1
+            for n, literal in enumerate(self.literals):
+                frm, at = found[n]
+                if frm > pos or 0 <= at < pos:
+                    at = folded.find(literal, pos, endpos)
+                    found[n] = (pos, at)
+                if at >= 0 and (idx < 0 or at < idx):
+                    idx = at
+            if idx < 0:
+                return None
+            start = string.rfind(b'\n', pos, idx) + 1 or pos
+            end = string.find(b'\n', idx, endpos) + 1 or endpos
+            m = search(string, start, end)
+            if m:
+                return m
+            pos = end
+            self.misses += 1
+            if (self.misses >= self.misses_judged and
+                    pos - self.first < self.misses * self.miss_gap):
+                self.misses = None
+                return search(string, pos, endpos)
+        return None
+
+
+def json_text(key, data):
+    """Return the field of a JSON record holding data, the text under
+    key if data is UTF-8, else its base64 under the bytes key, 'bytes'
+    for a line, 'file_bytes' for a file name.
+    """
+    try:
+        return {key: data.decode('utf-8')}
+    except UnicodeDecodeError:
+        key = 'bytes' if key == 'line' else key + '_bytes'
+        return {key: base64.b64encode(data).decode('ascii')}
 
 
 class GrepWorker:
@@ -535,20 +1101,102 @@ class GrepWorker:
     sep_line = b'--\n'
     c_sep_line = c_sep + b'--' + c_off + b'\n'
 
+    # patterns that depend on the boundary of the string,
+    # they can not be searched across a whole chunk.
+    string_anchors = re.compile(br'\\[AZ]|\(\?<?[=!]')
+
+    # patterns that may match a newline: a negated class, \s, \W, \D,
+    # a newline or a control character by its escape, or '.' under
+    # the s flag. Across a chunk, a match of one of them may run into
+    # the next line, whose '$' or '^' it then tests.
+    newline_chars = re.compile(br'\[\^|\\[sWDn0]|\\x0|\(\?[a-zA-Z]*s|\n')
+
+    # bytes of lines checked one by one after a matching line
+    run_size = 4096
+
+    # a pattern without any of these is a plain string
+    metachars = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+    # the flags a pattern sets for itself at its start
+    global_flags = re.compile(r'((?:\(\?[aiLmsux]+\))+)(.*)', re.S)
+
+    # number of plain strings for which an Aho-Corasick
+    # automaton beats an alternation of the re module.
+    ac_threshold = 128
+
+    # automata are shared by the workers of all files
+    automata = {}
+
+    # so are the patterns and the searchers, made once for the
+    # patterns and the options that shape them.
+    normal_patterns = {}
+    searchers = {}
+
+    # regular files of this size or larger are read in windows
+    window_threshold = 1 << 20
+
+    # the scan selects the lines of the -v option by itself,
+    # on_match and on_not_match are not swapped.
+    scan_inverts = False
+
+    # the shortest string a pattern requires that is worth a prefilter
+    prefilter_min = 3
+
+    # pieces of output gathered before they are written out at once
+    out_batch = 4096
+
+    # a piece of output this large is written out at once
+    out_piece = 1 << 16
+
+    # bytes of a regular file read at a time by pread, and
+    # searched in place, the lines are not copied out.
+    window_size = 1 << 22
+
     def __init__(self, pattern, options, ifile, ofile, bs=None):
+        """pattern is a string, or a list of strings for the -e and
+        -f options, a line matches if any of them matches.
+        """
         self.pattern = pattern
+        if isinstance(pattern, str):
+            self.patterns = [pattern]
+        else:
+            self.patterns = list(pattern)
         self.options = options
         self.ifile = ifile
         self.ofile = ofile
         self.bs = bs or 8192
-        self.nr = 0     # number of records
+        self.nr = 0     # number of records before self.nr_pos
+        self.nr_pos = 0
+        # the line numbers are counted only when they are written out
+        self.need_lnum = 'line_number' in options
         self.fname = self.make_fname(ifile.name)
         self.status = False
+        self.binary_files = options.get('binary_files', 'binary')
+
+        # for the -m option, the number of selected lines so far, and
+        # where the last one ends, in the chunk and in the file.
+        self.max_count = options.get('max_count')
+        self.selected = 0
+        self.line_end = 0
+        self.chunk_offset = None
+
+        # for the -b option, the offset of the chunk in the input, for
+        # a pipe as well, and where the line being written starts in it.
+        self.buf_offset = 0
+        self.line_start = 0
+
+        # the offset of the input where the search stops, for a segment
+        # of a file searched in parallel, None for the end of the file.
+        self.stop = None
+
+        # lines that do not match are split out of
+        # the chunk only when someone needs them.
+        self.want_not_match = False
 
         # Invert the sense of matching
-        if ('invert' in options and 'file_match' not in options
-                and 'count' not in options):
+        if 'invert' in options and not self.scan_inverts:
             self.on_match, self.on_not_match = self.on_not_match, self.on_match
+            self.want_not_match = True
 
         # set on_match method for -q option
         if 'quiet' in options:
@@ -561,24 +1209,50 @@ class GrepWorker:
 
         # setup color output
         color = options['color']
-        if color == 'always' or self.ofile.isatty() and color == 'auto':
+        if color == 'always' or color == 'auto' and self.ofile.isatty():
             self.sep_line = self.c_sep_line
             self.make_fname_str = self.make_color_fname_str
             self.make_lnum_str = self.make_color_lnum_str
             self.make_matcher = self.make_color_matcher
 
         self.matcher = self.make_matcher(options)
+        self.searcher = self.make_searcher(options)
 
-    def insert_line_number(self, lines, num, sep=b':'):
-        """Insert line number to the head of each line"""
-        num = str(num).encode()
-        num_str = self.make_lnum_str(num, sep)
-        return (b'%s%s' % (num_str, line) for line in lines)
+        # the hit found in the chunk is enough for to tell a line
+        # matches, unless all matches of the line are required.
+        self.need_all_matches = ('only_matching' in options
+                                 or self.make_matcher == self.make_color_matcher)
+        self.line_test = self.make_line_test(options)
 
-    def insert_file_name(self, lines, fname, sep=b':'):
-        """Insert file name to the head of each line"""
-        fname_str = self.make_fname_str(fname, sep)
-        return (b'%s%s' % (fname_str, line) for line in lines)
+        # the file name part of the prefixes is made once per file
+        self.out = []
+        self.fname_prefix = {b':': b'', b'-': b''}
+        if options['with_filename']:
+            for sep in self.fname_prefix:
+                self.fname_prefix[sep] = self.make_fname_str(self.fname, sep)
+
+        # for the --json option, each line is written as a record
+        if 'json' in options:
+            self.format_output = self.format_json
+            self.sep_line = b''
+            self.need_lnum = True
+            self.json_pattern = self.make_normal_matcher(options)
+            self.json_file = json_text('file', self.fname)
+
+        # for the -v option, the lines between the hits are written out
+        # in one piece, when none of them needs a prefix or a count.
+        self.write_regions = (self.want_not_match and not self.need_lnum
+                              and not options['with_filename']
+                              and not set(options) & set(['only_matching',
+                                    'max_count', 'quiet', 'byte_offset',
+                                    'json']))
+
+        # the lines are not probed one by one for the -b and --json
+        # options, the offset of a line comes from its position found
+        # by the search.
+        self.want_offsets = 'byte_offset' in options or 'json' in options
+        if self.want_offsets and 'only_matching' in options:
+            self.offset_pattern = self.make_normal_matcher(options)
 
     def make_lnum_str(self, num, sep):
         return num + sep
@@ -596,28 +1270,196 @@ class GrepWorker:
         raise GrepStatusDetermined
 
     def read(self):
-        """Return an enumerate object with line number"""
-        lines = self.ifile.readlines(self.bs)
-        if not lines:
-            return None
-        count = len(lines)
-        res = enumerate(lines, self.nr + 1)
-        self.nr += count
-        return res
+        """Return a chunk of about self.bs bytes, continue up to the
+        end of the line, so that a chunk always holds whole lines.
+        Nothing is read past self.stop, which ends a line.
+        """
+        size = self.bs
+        if self.stop is not None:
+            size = min(size, self.stop - self.ifile.tell())
+            if size <= 0:
+                return b''
+        chunk = self.ifile.read(size)
+        if chunk and not chunk.endswith(b'\n'):
+            chunk += self.ifile.readline()
+        return chunk
 
     def read_tty(self):
         """Read the terminal, line by line"""
-        line = self.ifile.readline()
-        if not line:
+        return self.ifile.readline()
+
+    def chunks(self):
+        """Generate (buf, start, end), the lines in buf[start:end] are
+        to be searched. A large regular file is read in windows,
+        others in chunks returned by self.read. A binary file has no
+        lines at all for the --binary-files=without-match option.
+        """
+        if self.binary_files == 'without-match' and is_binary(self.ifile):
+            return
+        fd = self.window_file()
+        if fd is not None:
+            yield from self.read_windows(fd)
+            return
+        while True:
+            self.chunk_offset = self.tell()
+            if self.chunk_offset is not None:
+                self.buf_offset = self.chunk_offset
+            chunk = self.read()
+            if not chunk:
+                break
+            yield chunk, 0, len(chunk)
+            if self.chunk_offset is None:
+                self.buf_offset += len(chunk)
+
+    def tell(self):
+        """Return the offset of the input file, None if it can not
+        be seeked.
+        """
+        try:
+            return self.ifile.tell() if self.ifile.seekable() else None
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def window_file(self):
+        """Return the descriptor of the input file if it is a regular
+        file large enough to be read in windows, None for pipes and
+        terminals.
+        """
+        ifile = self.ifile
+        if not isinstance(ifile, io.BufferedReader):
             return None
-        self.nr += 1
-        return [(self.nr, line)]
+        try:
+            fd = ifile.fileno()
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            if st.st_size - ifile.tell() < self.window_threshold:
+                return None
+            return fd
+        except (OSError, ValueError):
+            return None
+
+    def read_windows(self, fd):
+        """Generate windows of whole lines of the file read by pread,
+        from the current offset of the file on. A window ends at its
+        last newline, the rest is read again with the next one, and
+        a line longer than a window makes the windows grow. A file
+        that shrinks ends the search at its new end, as a short read.
+        The file offset is left at the end of the last window searched.
+        """
+        ifile = self.ifile
+        pos = ifile.tell()
+        stop = self.stop
+        size = self.window_size
+        try:
+            while stop is None or pos < stop:
+                want = size if stop is None else min(size, stop - pos)
+                data = os.pread(fd, want, pos)
+                if not data:
+                    break
+                end = len(data)
+                if end == want and (stop is None or pos + end < stop):
+                    end = data.rfind(b'\n') + 1
+                    if not end:
+                        size *= 2
+                        continue
+                self.chunk_offset = self.buf_offset = pos
+                yield data, 0, end
+                pos += end
+        finally:
+            ifile.seek(pos)
+            correct_offset(ifile)
+
+    def line_number(self, buf, pos):
+        """Return the line number of the line starting at pos, the
+        newlines are counted from the last known position onward.
+        Without need_lnum, nothing is counted and 0 is returned.
+        """
+        if not self.need_lnum:
+            return 0
+        self.nr += buf.count(b'\n', self.nr_pos, pos)
+        self.nr_pos = pos
+        return self.nr + 1
+
+    def is_literal(self, pattern):
+        """Tell whether the pattern can be searched as a plain string,
+        either by the -F option, or by the lack of metacharacters.
+        """
+        if not pattern:
+            return False
+        if 'fixed_strings' in self.options:
+            return True
+        return not self.metachars.search(pattern)
+
+    def pattern_key(self, options):
+        return (tuple(self.patterns), 'fixed_strings' in options,
+                'ignore_case' in options, 'word_regexp' in options)
 
     def make_normal_matcher(self, options):
+        key = self.pattern_key(options)
+        if key not in self.normal_patterns:
+            self.normal_patterns[key] = self.build_normal_matcher()
+        return self.normal_patterns[key]
+
+    def build_normal_matcher(self):
+        patterns = self.patterns
+        if len(patterns) == 1 and self.is_literal(patterns[0]):
+            return self.make_literal(patterns[0])
+
+        # a large set of plain strings goes to an automaton, the
+        # rest are combined into an alternation of the re module.
+        literals = [x for x in patterns if self.is_literal(x)]
+        if len(literals) < self.ac_threshold:
+            literals = []
+        excluded = set(literals)
+        regexps = [x for x in patterns if x not in excluded]
+        pats = []
+        if literals:
+            pats.append(self.make_automaton(literals))
+        if regexps or not pats:
+            pats.append(self.make_regexp(regexps))
+        return pats[0] if len(pats) == 1 else PatternSet(pats)
+
+    def make_literal(self, pattern):
+        return LiteralPattern(pattern.encode(),
+                              'ignore_case' in self.options,
+                              'word_regexp' in self.options)
+
+    def make_automaton(self, patterns):
+        ignore_case = 'ignore_case' in self.options
+        word_regexp = 'word_regexp' in self.options
+        key = (tuple(patterns), ignore_case, word_regexp)
+        if key not in self.automata:
+            literals = [x.encode() for x in patterns]
+            self.automata[key] = AhoCorasick(literals, ignore_case,
+                                             word_regexp)
+        return self.automata[key]
+
+    def make_regexp(self, patterns):
+        """Combine the patterns into one compiled pattern, an empty
+        list results in a pattern that never matches.
+        """
+        if not patterns:
+            pat = '(?!)'
+        elif len(patterns) == 1:
+            pat = patterns[0]
+            if 'fixed_strings' in self.options:
+                pat = re.escape(pat)
+            else:
+                pat = self.scope_flags(pat)
+        else:
+            # plain strings go first, the longest first,
+            # to favor the longest of the overlapping ones.
+            literals = [x for x in patterns if self.is_literal(x)]
+            literals.sort(key=len, reverse=True)
+            literals = [re.escape(x) for x in literals]
+            regexps = [self.scope_flags(x) for x in patterns
+                       if not self.is_literal(x)]
+            pat = '|'.join('(?:%s)' % x for x in literals + regexps)
+
         # handle -w option, match word boundary
-        pat = self.pattern
         if 'word_regexp' in self.options:
-            pat = r'\b%s\b' % pat
+            pat = r'\b(?:%s)\b' % pat
 
         # handle -i option, ignore case
         flags = 0
@@ -625,31 +1467,133 @@ class GrepWorker:
             flags |= re.IGNORECASE
         pat = re.compile(pat.encode(), flags)
 
+        # a pattern that depends on the boundary of the string, or may
+        # match a newline, sees each line as a string of its own.
+        if (self.string_anchors.search(pat.pattern) or
+                self.newline_chars.search(pat.pattern)):
+            return LinePattern(pat)
         return pat
 
+    def scope_flags(self, pattern):
+        """Turn the flags a pattern sets at its start, such as (?i),
+        into a group of its own, (?i:...), so that the pattern can be
+        joined with others or wrapped for -w. Under the x flag, a
+        comment at the end of the pattern stops at a newline, not at
+        the end of the group.
+        """
+        m = self.global_flags.match(pattern)
+        if not m:
+            return pattern
+        flags = ''.join(re.findall(r'[aiLmsux]', m.group(1)))
+        end = '\n)' if 'x' in flags else ')'
+        return '(?%s:%s%s' % (flags, m.group(2), end)
+
     def make_matcher(self, options):
         pat = self.make_normal_matcher(options)
+        if 'only_matching' in options:
+            class O:
+                def findall(self, line):
+                    """The whole matches, even if the pattern has groups"""
+                    return [m.group() for m in pat.finditer(line)], line
+            return O()
         class C:
             def findall(self, line):
                 return pat.findall(line), line
         return C()
 
+    def make_line_test(self, options):
+        """Return a function telling if a line matches, for when its
+        matches are not needed. A plain string is tested by a pattern
+        of the re module, far faster on a short line than the find of
+        LiteralPattern, or even the in operator.
+        """
+        pat = self.make_normal_matcher(options)
+        if isinstance(pat, LinePattern):
+            # a line is searched without its newline
+            search = pat.pat.search
+            return lambda line: search(line.rstrip(b'\n'))
+        if isinstance(pat, LiteralPattern):
+            regexp = re.escape(pat.literal)
+            if pat.word_regexp:
+                regexp = br'\b%s\b' % regexp
+            pat = re.compile(regexp, re.IGNORECASE if pat.ignore_case else 0)
+        return pat.search
+
     def make_color_matcher(self, options):
         pat = self.make_normal_matcher(options)
         c_match = self.c_match
         c_off = self.c_off
+        if (isinstance(pat, LiteralPattern)
+                and not pat.ignore_case and not pat.word_regexp):
+            literal = pat.literal
+            colored = c_match + literal + c_off
+            class L:
+                def findall(self, line):
+                    """A plain string is colored by bytes.replace"""
+                    n = line.count(literal)
+                    if not n:
+                        return [], line
+                    return [colored] * n, line.replace(literal, colored)
+            return L()
+
         class C:
             def findall(self, line):
-                matches = pat.findall(line)
+                """Color the matches in one pass over the line, the
+                colored line is made of slices between them.
+                """
+                matches = []
+                parts = []
+                last = 0
+                for m in pat.finditer(line):
+                    start, end = m.span()
+                    colored = c_match + line[start:end] + c_off
+                    matches.append(colored)
+                    parts.append(line[last:start])
+                    parts.append(colored)
+                    last = end
                 if matches:
-                    matches = [c_match + x + c_off for x in matches]
-                    line = re.sub(pat, self.apply_color, line)
+                    parts.append(line[last:])
+                    line = b''.join(parts)
                 return matches, line
-            def apply_color(self, m):
-                return c_match + m.group() + c_off
 
         return C()
 
+    def make_searcher(self, options):
+        """Make the pattern for searching a whole chunk, a pattern of
+        the re module is searched only around the strings it requires,
+        when they are long enough to be rare. The strings are found
+        case-insensitively for the -i option, or if the pattern may
+        set flags of its own.
+        """
+        key = self.pattern_key(options)
+        if key not in self.searchers:
+            self.searchers[key] = self.build_searcher(options)
+        return self.searchers[key]
+
+    def build_searcher(self, options):
+        pat = self.make_chunk_pattern(self.make_normal_matcher(options))
+        if isinstance(pat, BytesPattern):
+            return pat
+        ignore_case = ('ignore_case' in options or
+                       any('(?' in x for x in self.patterns))
+        alternatives = required_literals(self.patterns, options, ignore_case)
+        literals = set(max(alt, key=len) for alt in alternatives)
+        if not literals or min(map(len, literals)) < self.prefilter_min:
+            return pat
+        return Prefilter(pat, sorted(literals), ignore_case)
+
+    def make_chunk_pattern(self, pat):
+        """'^' and '$' shall match at the boundary of every line in
+        the chunk, the patterns of the re module are recompiled. A
+        LinePattern searches one line at a time already.
+        """
+        if isinstance(pat, PatternSet):
+            return PatternSet([self.make_chunk_pattern(x)
+                               for x in pat.patterns])
+        if isinstance(pat, (BytesPattern, LinePattern)):
+            return pat
+        return re.compile(pat.pattern, pat.flags | re.MULTILINE)
+
     def make_fname(self, name):
         """Make a file name for output"""
         if name == 0:
@@ -658,92 +1602,543 @@ class GrepWorker:
             name = str(name).encode()
         return name
 
-    def format_output(self, lines, lnum, options, sep=b':'):
-        """Format lines for output"""
+    def format_output(self, lines, lnum, options, sep=b':', offset=None):
+        """Format lines for output, the file name, the line number and
+        the byte offset are joined into one prefix for all the lines.
+        The offset is that of the line being written, unless given.
+        """
+        prefix = self.fname_prefix[sep]
+
         # handle -n option, show line number
         if 'line_number' in options:
-            lines = self.insert_line_number(lines, lnum, sep)
+            prefix += self.make_lnum_str(b'%d' % lnum, sep)
 
-        # insert file name if necessary
-        if options['with_filename']:
-            lines = self.insert_file_name(lines, self.fname, sep)
+        # handle -b option, show byte offset, colored as a line number
+        if 'byte_offset' in options:
+            if offset is None:
+                offset = self.buf_offset + self.line_start
+            prefix += self.make_lnum_str(b'%d' % offset, sep)
 
+        if prefix:
+            lines = [prefix + x for x in lines]
         return lines
 
+    def format_json(self, lines, lnum, options, sep=b':', offset=None):
+        """Format lines as JSON records for the --json option, one per
+        line, a context line is told by the '-' separator. The byte
+        offset and the spans of the matches count bytes. A line that
+        is not UTF-8 is given as base64 bytes rather than text.
+        """
+        if offset is None:
+            offset = self.buf_offset + self.line_start
+        records = []
+        for line in lines:
+            if line.endswith(b'\n'):
+                line = line[:-1]
+            record = {'type': 'match' if sep == b':' else 'context'}
+            record.update(self.json_file)
+            record['line_number'] = lnum
+            record['byte_offset'] = offset
+            record.update(json_text('line', line))
+            if sep == b':':
+                record['submatches'] = [
+                    m.span() for m in self.json_pattern.finditer(line)
+                    if m.end() > m.start()]
+            records.append(json.dumps(record, separators=(',', ':'))
+                           .encode() + b'\n')
+        return records
+
     def write(self, lines):
-        self.ofile.writelines(lines)
+        """Gather the lines, they are written out in batches"""
+        out = self.out
+        out += lines
+        if len(out) >= self.out_batch:
+            self.flush()
 
     def write_tty(self, lines):
         """Write to terminal, flush after every write"""
         self.ofile.writelines(lines)
         self.ofile.flush()
 
+    def flush(self):
+        """Write out the lines gathered"""
+        if self.out:
+            self.ofile.writelines(self.out)
+            self.out.clear()
+
     def on_match(self, matches, line, lnum):
         self.status = True
         # handle -o option, show only the matched part
         if 'only_matching' in self.options:
-            lines = (x + b'\n' for x in matches)
+            if 'byte_offset' in self.options:
+                self.write_offset_matches(line, lnum)
+                lines = []
+            else:
+                lines = [x + b'\n' for x in matches if x]
         else:
             lines = [line]
-        lines = self.format_output(lines, lnum, self.options)
-        self.write(lines)
+        self.write(self.format_output(lines, lnum, self.options))
+        self.selected += 1
+        if self.selected == self.max_count:
+            raise GrepMaxCountReached
+
+    def write_offset_matches(self, line, lnum):
+        """Write the matches of the line for the -o option, each with
+        its own byte offset.
+        """
+        offset = self.buf_offset + self.line_start
+        for m in self.offset_pattern.finditer(line):
+            if m.end() > m.start():
+                self.write(self.format_output([m.group() + b'\n'], lnum,
+                                              self.options, b':',
+                                              offset + m.start()))
 
     def on_not_match(self, *args, **kargs):
         return None
 
-    def run(self):
-        while True:
-            lines_data = self.read()
-            if not lines_data:
-                break
-            for n, line in lines_data:
-                matches, line = self.matcher.findall(line)
+    def on_not_match_lines(self, buf, start, end):
+        """Lines in buf[start:end] do not match, they are split
+        and handed over to on_not_match only when wanted.
+        """
+        if not self.want_not_match:
+            return
+        if self.write_regions:
+            self.status = True
+            self.write([buf[start:end]])
+            if end - start >= self.out_piece:
+                self.flush()
+            return
+        lnum = self.line_number(buf, start)
+        self.line_end = start
+        for n, line in enumerate(split_lines(buf[start:end]), lnum):
+            self.line_start = self.line_end
+            self.line_end += len(line)
+            self.on_not_match([], line, n)
+
+    def scan(self, buf, pos, size):
+        """Search the lines in buf[pos:size] for hits, only the lines
+        holding a hit are split out and checked by the matcher.
+        """
+        search = self.searcher.search
+        findall = self.matcher.findall
+        test = self.line_test
+        need_all = self.need_all_matches
+        find = buf.find
+        rfind = buf.rfind
+        self.nr_pos = pos
+        probe = False
+        while pos < size:
+            if probe:
+                # the lines next to a matching line are likely to
+                # match as well, check a run of them one by one.
+                end = find(b'\n', pos + self.run_size, size) + 1 or size
+                lines = split_lines(buf[pos:end])
+                if self.write_regions:
+                    # the lines that do not match are picked out in C
+                    # and written in one piece.
+                    kept = list(itertools.filterfalse(test, lines))
+                    if kept:
+                        self.status = True
+                        self.write([b''.join(kept)])
+                    lnum = self.nr + len(lines)
+                    matches = test(lines[-1])
+                    dense = len(kept) * 2 < len(lines)
+                else:
+                    hits = 0
+                    try:
+                        for lnum, line in enumerate(lines, self.nr + 1):
+                            if need_all:
+                                matches, line = findall(line)
+                            else:
+                                matches = [line] if test(line) else []
+                            if matches:
+                                hits += 1
+                                self.on_match(matches, line, lnum)
+                            else:
+                                self.on_not_match(matches, line, lnum)
+                    except GrepMaxCountReached:
+                        n = lnum - self.nr
+                        self.line_end = pos + sum(map(len, lines[:n]))
+                        raise
+                    dense = hits * 2 > len(lines)
+            else:
+                m = search(buf, pos, size)
+                if not m:
+                    break
+                hit, hit_end = m.span()
+                start = rfind(b'\n', pos, hit) + 1 or pos
+                if start == size:   # empty match after the last line
+                    break
+                end = find(b'\n', hit, size) + 1 or size
+                dense = pos == start
+                if pos < start:
+                    self.on_not_match_lines(buf, pos, start)
+                if hit_end <= end and not need_all:
+                    matches, line = [m.group()], buf[start:end]
+                else:
+                    matches, line = findall(buf[start:end])
+                lnum = self.line_number(buf, start)
+                self.line_start, self.line_end = start, end
                 if matches:
-                    self.on_match(matches, line, n)
+                    self.on_match(matches, line, lnum)
                 else:
-                    self.on_not_match(matches, line, n)
+                    self.on_not_match(matches, line, lnum)
+            self.nr, self.nr_pos = lnum, end
+            # the lines between the hits are best written as a region,
+            # unless the hits are close together.
+            probe = bool(matches) and (dense or not self.write_regions)
+            probe = probe and not self.want_offsets
+            pos = end
+        if pos < size:
+            self.on_not_match_lines(buf, pos, size)
+
+        # carry the line count over to the next chunk
+        self.line_number(buf, size)
+
+    def run(self):
+        chunks = self.chunks()
+        try:
+            for buf, start, end in chunks:
+                self.scan(buf, start, end)
+        except GrepMaxCountReached:
+            self.on_max_count(buf, end, chunks)
+        finally:
+            chunks.close()
+            self.flush()
         return self.status
 
+    def on_max_count(self, buf, end, chunks):
+        """The -m option stops the search after the line ending at
+        self.line_end in buf, a seekable input file is left just past
+        it, whatever is read for the trailing context.
+        """
+        offset = self.chunk_offset
+        if offset is not None:
+            offset += self.line_end
+        self.write_trailing_context(buf, end, chunks)
+        chunks.close()
+        if offset is not None:
+            self.ifile.seek(offset)
+            correct_offset(self.ifile)
+
+    def write_trailing_context(self, buf, end, chunks):
+        return None
+
 
 class GrepWorkerAgg(GrepWorker):
 
+    scan_inverts = True
+
     def __init__(self, *args, **kargs):
         super(GrepWorkerAgg, self).__init__(*args, **kargs)
         self.match_count = 0
+        self.line_counter = self.make_line_counter()
 
     def format_output(self, lines, options):
         """Format lines for output"""
         # insert file name if necessary
-        if options['with_filename']:
-            lines = self.insert_file_name(lines, self.fname)
+        prefix = self.fname_prefix[b':']
+        if prefix:
+            lines = [prefix + x for x in lines]
         return lines
 
-    def on_match(self, matches, line, lnum):
-        self.status = True
-        self.match_count += 1
+    def make_line_counter(self):
+        """Return a function that counts the matching lines of a list,
+        the loop runs in C for the patterns that allow it.
+        """
+        pat = self.make_normal_matcher(self.options)
+        if isinstance(pat, LiteralPattern) and not pat.word_regexp:
+            literal = pat.literal
+            ignore_case = pat.ignore_case
+            def counter(lines):
+                if ignore_case:
+                    lines = map(bytes.lower, lines)
+                found = map(operator.contains, lines, itertools.repeat(literal))
+                return sum(found)
+        elif isinstance(pat, LinePattern):
+            # a line is searched without its newline
+            search = pat.pat.search
+            newlines = itertools.repeat(b'\n')
+            def counter(lines):
+                lines = map(bytes.rstrip, lines, newlines)
+                return len(list(filter(None, map(search, lines))))
+        else:
+            search = pat.search
+            def counter(lines):
+                return len(list(filter(None, map(search, lines))))
+        return counter
+
+    def scan(self, buf, pos, size):
+        """Count the selected lines in buf[pos:size] without splitting
+        them out, the search goes on from the end of the line after
+        the first hit in it. For the -v option, the count is
+        subtracted from the number of lines. The count stops at the
+        limit of the -m option, where the -v option counts the lines
+        between the hits instead, to find the line to stop after.
+        """
+        search = self.searcher.search
+        findall = self.matcher.findall
+        find = buf.find
+        rfind = buf.rfind
+        first = pos
+        invert = 'invert' in self.options
+        limit = None
+        if self.max_count is not None:
+            limit = self.max_count - self.match_count
+        gaps = invert and limit is not None
+        count = 0
+        dense = False
+        while pos < size and count != limit:
+            if dense:
+                # most lines match, count a run of them one by one
+                end = find(b'\n', pos + self.run_size, size) + 1 or size
+                lines = split_lines(buf[pos:end])
+                found = self.line_counter(lines)
+                count += found
+                dense = found * 2 > len(lines)
+                pos = end
+                continue
+            m = search(buf, pos, size)
+            if not m:
+                break
+            hit, hit_end = m.span()
+            start = rfind(b'\n', pos, hit) + 1 or pos
+            if start == size:   # empty match after the last line
+                break
+            end = find(b'\n', hit, size) + 1 or size
+            # a match across lines needs the line to confirm
+            matched = hit_end <= end or findall(buf[start:end])[0]
+            if gaps:
+                count = self.count_lines(buf, pos, start if matched else end,
+                                         count, limit)
+            elif matched:
+                count += 1
+                self.line_end = end
+                dense = start == pos and limit is None
+            pos = end
+
+        if gaps and count != limit:
+            count = self.count_lines(buf, pos, size, count, limit)
+        elif invert and not gaps:
+            count = self.count_lines(buf, first, size, 0, None) - count
+
+        if count:
+            self.status = True
+            if 'quiet' in self.options:
+                raise GrepStatusDetermined
+        self.match_count += count
+        if count == limit:
+            raise GrepMaxCountReached
+
+    def count_lines(self, buf, pos, end, count, limit):
+        """Add the lines in buf[pos:end] to count, the last one may
+        lack a newline. The count stops at limit, self.line_end is
+        left at the end of the last line counted.
+        """
+        if pos >= end:
+            return count
+        n = buf.count(b'\n', pos, end)
+        if buf[end-1:end] != b'\n':
+            n += 1
+        if limit is None or count + n < limit:
+            self.line_end = end
+            return count + n
+        for _ in range(limit - count):
+            pos = buf.find(b'\n', pos, end) + 1 or end
+        self.line_end = pos
+        return limit
 
     def run(self):
         status = super(GrepWorkerAgg, self).run()
         lines = [str(self.match_count).encode() + b'\n']
         lines = self.format_output(lines, self.options)
         self.write(lines)
+        self.flush()
         return status
 
 
+class GrepWorkerOnlyMatching(GrepWorker):
+
+    """Write the matches for the -o option straight from a search over
+    the whole chunk, the lines are never split out. A line number is
+    counted only for a line holding a match, from the line of the
+    previous match on.
+    """
+
+    def __init__(self, *args, **kargs):
+        super(GrepWorkerOnlyMatching, self).__init__(*args, **kargs)
+        self.colored = self.make_matcher == self.make_color_matcher
+
+    def spans(self, buf, pos, size):
+        """Yield the spans of the matches in the chunk. A match that
+        runs over the end of its line is searched again within the
+        line, as the lines are searched one by one.
+        """
+        find = buf.find
+        pat = self.searcher
+        if (isinstance(pat, LiteralPattern) and not pat.ignore_case
+                and not pat.word_regexp):
+            # a plain literal never holds a newline
+            literal = pat.literal
+            step = len(literal)
+            idx = find(literal, pos, size)
+            while idx >= 0:
+                yield idx, idx + step
+                idx = find(literal, idx + step, size)
+            return
+        finditer = pat.finditer
+        while pos < size:
+            last = pos
+            for m in finditer(buf, pos, size):
+                start, end = m.span()
+                nl = find(b'\n', start, end)
+                if nl < 0:
+                    yield start, end
+                    last = end
+                    continue
+                line_start = buf.rfind(b'\n', last, start) + 1 or last
+                for m in finditer(buf, line_start, nl):
+                    yield m.span()
+                pos = nl + 1
+                break
+            else:
+                return
+
+    def scan(self, buf, pos, size):
+        """The empty matches are not written, though they select their
+        line. For the -m option, the search stops at the end of the
+        last line selected.
+        """
+        find = buf.find
+        rfind = buf.rfind
+        c_match = self.c_match if self.colored else b''
+        c_off = self.c_off if self.colored else b''
+        line_number = self.need_lnum
+        byte_offset = self.want_offsets
+        prefix = fname_prefix = self.fname_prefix[b':']
+        lines = []
+        line_end = last = pos
+        self.nr_pos = pos
+        for start, end in self.spans(buf, pos, size):
+            if start == size:  # an empty match after the last line
+                break
+            if start >= line_end:
+                # the first match in a line, an empty one selects the
+                # line as well
+                if self.selected == self.max_count:
+                    break
+                self.selected += 1
+                self.status = True
+                if 'quiet' in self.options:
+                    raise GrepStatusDetermined
+                line_end = find(b'\n', end, size) + 1 or size
+                self.line_end = line_end
+                if line_number:
+                    line_start = rfind(b'\n', last, start) + 1 or last
+                    if line_start != self.nr_pos:
+                        self.nr += buf.count(b'\n', self.nr_pos, line_start)
+                    # the count goes on from the end of this line
+                    self.nr += 1
+                    self.nr_pos = line_end
+                    lnum = b'%d' % self.nr
+                    prefix = fname_prefix + self.make_lnum_str(lnum, b':')
+            if start == end:
+                continue
+            if byte_offset:
+                offset = b'%d' % (self.buf_offset + start)
+                lines.append(prefix + self.make_lnum_str(offset, b':') +
+                             c_match + buf[start:end] + c_off + b'\n')
+            elif c_match:
+                lines.append(prefix + c_match + buf[start:end] + c_off + b'\n')
+            else:
+                lines.append(prefix + buf[start:end] + b'\n')
+            last = end
+        self.write(lines)
+
+        if self.selected == self.max_count:
+            raise GrepMaxCountReached
+
+        # carry the line count over to the next chunk
+        self.line_number(buf, size)
+
+
 class GrepWorkerFileName(GrepWorker):
 
+    """Name the files that have a selected line for the -l option,
+    the files that have none for the -L option.
+    """
+
+    scan_inverts = True
+
+    def __init__(self, *args, **kargs):
+        super(GrepWorkerFileName, self).__init__(*args, **kargs)
+        self.without_match = 'files_without_match' in self.options
+
     def on_match(self, matches, line, lnum):
         raise GrepNameDetermined
 
+    def scan(self, buf, pos, size):
+        """Stop at the first selected line in buf[pos:size], no line
+        is split out and no line number counted. For the -v option,
+        a line is selected if it lies between the hits, or after the
+        last one.
+        """
+        search = self.searcher.search
+        findall = self.matcher.findall
+        find = buf.find
+        rfind = buf.rfind
+        invert = 'invert' in self.options
+        while pos < size:
+            m = search(buf, pos, size)
+            if not m:
+                break
+            hit, hit_end = m.span()
+            start = rfind(b'\n', pos, hit) + 1 or pos
+            if start == size:   # empty match after the last line
+                break
+            if invert and pos < start:
+                self.on_match([], None, None)
+            end = find(b'\n', hit, size) + 1 or size
+            # a match across lines needs the line to confirm
+            if hit_end <= end or findall(buf[start:end])[0]:
+                if not invert:
+                    self.on_match([m.group()], None, None)
+            elif invert:
+                self.on_match([], None, None)
+            pos = end
+        if invert and pos < size:
+            self.on_match([], None, None)
+
     def run(self):
         try:
             super(GrepWorkerFileName, self).run()
             status = False
         except GrepNameDetermined:
-            self.write([self.fname + b'\n'])
             status = True
+        if status != self.without_match:
+            self.write_name()
+            self.flush()
         return status
 
+    def write_name(self):
+        self.write([self.fname + b'\n'])
+
+
+class GrepWorkerBinary(GrepWorkerFileName):
+
+    """Tell that a binary file matches, instead of writing out its
+    lines, the search stops at the first selected line.
+    """
+
+    def write_name(self):
+        if 'json' in self.options:
+            record = {'type': 'binary'}
+            record.update(self.json_file)
+            self.write([json.dumps(record, separators=(',', ':')).encode()
+                        + b'\n'])
+            return
+        self.write([b'Binary file %s matches\n' % self.fname])
+
 
 class GrepWorkerContext(GrepWorker):
 
@@ -751,7 +2146,10 @@ class GrepWorkerContext(GrepWorker):
         super(GrepWorkerContext, self).__init__(*args, **kargs)
         self.before = self.options.get('before', 0)
         self.after = self.options.get('after', 0)
-        self.b_buf = []
+        self.b_buf = collections.deque(maxlen=self.before)
+        # the separators are placed by the line numbers
+        self.need_lnum = True
+        self.write_regions = False
         self.a_counter = 0
         self.last_written_lnum = 0
 
@@ -762,18 +2160,11 @@ class GrepWorkerContext(GrepWorker):
             self.write([self.sep_line])
 
     def on_match(self, matches, line, lnum):
-        # the 'before' buffer may contain more lines than needed,
-        # truncate it before writing the separator in order not
-        # to interfere the line number calculation.
-        if self.before:
-            self.b_buf = self.b_buf[-self.before:]
-        else:
-            self.b_buf.clear()
         self.write_separator(lnum)
         self.write_b_buffer()
-        super(GrepWorkerContext, self).on_match(matches, line, lnum)
         self.last_written_lnum = lnum
         self.reset_a_counter()
+        super(GrepWorkerContext, self).on_match(matches, line, lnum)
 
     def on_not_match(self, matches, line, lnum):
         if self.a_counter:
@@ -783,7 +2174,67 @@ class GrepWorkerContext(GrepWorker):
             self.last_written_lnum = lnum
             self.a_counter -= 1
         else:
-            self.b_buf.append((lnum, line))
+            offset = self.buf_offset + self.line_start
+            self.b_buf.append((lnum, line, offset))
+
+    def on_not_match_lines(self, buf, start, end):
+        """Lines in buf[start:end] do not match, only the first ones
+        wanted for the 'after' context and the last ones kept for the
+        'before' context are split out, the lines in between are
+        skipped by their newlines. For the -v option, all of them are
+        selected.
+        """
+        if 'invert' in self.options:
+            super(GrepWorkerContext, self).on_not_match_lines(buf, start, end)
+            return
+        if self.a_counter:
+            pos = start
+            for _ in range(self.a_counter):
+                pos = buf.find(b'\n', pos, end) + 1 or end
+                if pos == end:
+                    break
+            lnum = self.line_number(buf, start)
+            lines = split_lines(buf[start:pos])
+            for n, line in enumerate(lines, lnum):
+                self.line_start = start
+                start += len(line)
+                self.on_not_match([], line, n)
+            start = pos
+        if self.before and start < end:
+            pos = end
+            for _ in range(self.before):
+                pos = buf.rfind(b'\n', start, pos - 1) + 1 or start
+                if pos == start:
+                    break
+            lnum = self.line_number(buf, pos)
+            lines = split_lines(buf[pos:end])
+            offsets = itertools.accumulate(
+                    [self.buf_offset + pos] + [len(x) for x in lines[:-1]])
+            self.b_buf.extend(zip(itertools.count(lnum), lines, offsets))
+
+    def write_trailing_context(self, buf, end, chunks):
+        """Write the 'after' context of the last selected line of the
+        -m option, the lines that follow are context even if they
+        match, as in GNU grep.
+        """
+        pos = self.line_end
+        while self.a_counter:
+            if pos >= end:
+                self.line_number(buf, end)
+                buf, pos, end = next(chunks, (None, 0, 0))
+                if buf is None:
+                    break
+                self.nr_pos = pos
+                continue
+            stop = pos
+            for _ in range(self.a_counter):
+                stop = buf.find(b'\n', stop, end) + 1 or end
+            lnum = self.line_number(buf, pos)
+            for n, line in enumerate(split_lines(buf[pos:stop]), lnum):
+                self.line_start = pos
+                pos += len(line)
+                GrepWorkerContext.on_not_match(self, [], line, n)
+            pos = stop
 
     def reset_a_counter(self):
         self.a_counter = self.after
@@ -795,52 +2246,602 @@ class GrepWorkerContext(GrepWorker):
 
         # write only when -o option is not presented,
         if 'only_matching' not in self.options:
-            for lnum, line in self.b_buf:
-                lines = self.format_output([line], lnum, self.options, b'-')
+            for lnum, line, offset in self.b_buf:
+                lines = self.format_output([line], lnum, self.options, b'-',
+                                           offset)
                 self.write(lines)
 
         self.last_written_lnum = self.b_buf[-1][0]
         self.b_buf.clear()
 
-    def run(self):
-        bs = self.before
-        while True:
-            self.b_buf = self.b_buf[-bs:]
-            lines_data = self.read()
-            if not lines_data:
-                break
-            for n, line in lines_data:
-                matches, line = self.matcher.findall(line)
-                if matches:
-                    self.on_match(matches, line, n)
-                else:
-                    self.on_not_match(matches, line, n)
-        return self.status
 
+class TreeWalker:
+
+    """Generate the regular files under the given names with
+    os.scandir, descending into directories depth first. The type of
+    an entry comes from the directory itself, no stat is needed unless
+    it is a symbolic link. Only one open directory per level is kept,
+    memory does not grow with the size of the tree.
+
+    With -R the symbolic links met on the way down are followed, with
+    -r they are passed over; the names given are followed either way.
+    A directory is identified by its (st_dev, st_ino), one that is its
+    own ancestor is a loop, warned about and not entered again. With
+    --skip-duplicates every directory and file reached twice, through
+    another link or a hard link, is searched only the first time.
 
-def recursive_walk(worker, names, pattern, options):
+    Files are selected by the glob patterns of --include and --exclude,
+    and directories pruned by --exclude-dir, all matched against the
+    base name. With --gitignore, the .gitignore files found on the way
+    down prune the files and directories they ignore.
+    """
+
+    def __init__(self, options):
+        self.include = self.compile_globs(options.get('include'))
+        self.exclude = self.compile_globs(options.get('exclude'))
+        self.exclude_dir = self.compile_globs(options.get('exclude_dir'))
+        self.gitignore = 'gitignore' in options
+        self.follow_links = 'drecursive' in options
+        self.seen = set() if 'skip_duplicates' in options else None
+
+    def compile_globs(self, globs):
+        if not globs:
+            return None
+        pat = '|'.join(fnmatch.translate(x) for x in globs)
+        return re.compile(pat)
+
+    def is_selected(self, name):
+        """Tell if a file of the base name shall be searched"""
+        if self.include and not self.include.match(name):
+            return False
+        if self.exclude and self.exclude.match(name):
+            return False
+        return True
+
+    def walk(self, names, status_list):
+        """Failure of reading a directory adds a False to status_list"""
+        for name in names:
+            if os.path.isfile(name):
+                if not self.is_selected(os.path.basename(name)):
+                    continue
+                if self.seen is not None and self.is_seen(os.stat(name)):
+                    continue
+                yield name
+            elif os.path.isdir(name):
+                yield from self.walk_dir(name, status_list)
+
+    def walk_dir(self, top, status_list):
+        stack = []
+        ancestors = set()
+        self.push_dir(stack, ancestors, top, os.stat(top), (), status_list)
+        while stack:
+            entries, rules, key = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                entries.close()
+                stack.pop()
+                ancestors.discard(key)
+                continue
+            name = entry.name
+            if self.is_dir(entry):
+                if self.exclude_dir and self.exclude_dir.match(name):
+                    continue
+                if self.gitignore and (name == '.git' or
+                        self.is_ignored(entry.path, True, rules)):
+                    continue
+                st = self.stat(entry)
+                if st is None:
+                    continue
+                self.push_dir(stack, ancestors, entry.path, st, rules,
+                              status_list)
+            elif self.is_file(entry):
+                if not self.is_selected(name):
+                    continue
+                if rules and self.is_ignored(entry.path, False, rules):
+                    continue
+                if self.seen is not None:
+                    st = self.stat(entry)
+                    if st is None or self.is_seen(st):
+                        continue
+                yield entry.path
+
+    def push_dir(self, stack, ancestors, path, st, rules, status_list):
+        """Open the directory, push it onto the stack along with the
+        gitignore rules in effect inside it and its identity. A loop
+        back to an ancestor is not entered.
+        """
+        key = (st.st_dev, st.st_ino)
+        if key in ancestors:
+            print('%s: warning: recursive directory loop' % path,
+                  file=sys.stderr)
+            return
+        if self.seen is not None and self.is_seen(st):
+            return
+        try:
+            entries = os.scandir(path)
+        except OSError as e:
+            print(str(e), file=sys.stderr)
+            status_list.append(False)
+        else:
+            stack.append((entries, self.read_gitignore(path, rules), key))
+            ancestors.add(key)
+
+    def is_seen(self, st):
+        """Remember the file, tell if it was reached before"""
+        key = (st.st_dev, st.st_ino)
+        if key in self.seen:
+            return True
+        self.seen.add(key)
+        return False
+
+    def stat(self, entry):
+        try:
+            return entry.stat(follow_symlinks=self.follow_links)
+        except OSError:
+            return None
+
+    def is_dir(self, entry):
+        try:
+            return entry.is_dir(follow_symlinks=self.follow_links)
+        except OSError:
+            return False
+
+    def is_file(self, entry):
+        try:
+            return entry.is_file(follow_symlinks=self.follow_links)
+        except OSError:
+            return False
+
+    def read_gitignore(self, path, rules):
+        """Return the rules of path/.gitignore appended to the rules
+        inherited from the parent directories. Each rule is a tuple of
+        (base directory, compiled glob, negated, directory only,
+        matched against the relative path rather than the base name).
+        """
+        if not self.gitignore:
+            return rules
+        try:
+            with open(os.path.join(path, '.gitignore')) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return rules
+        new_rules = []
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if line.startswith('**/'):
+                line, anchored = line[3:], False
+            if not line:
+                continue
+            glob = re.compile(fnmatch.translate(line))
+            new_rules.append((path, glob, negated, dir_only, anchored))
+        return rules + tuple(new_rules)
+
+    def is_ignored(self, path, is_dir, rules):
+        """The last rule that matches decides"""
+        ignored = False
+        for base, glob, negated, dir_only, anchored in rules:
+            if dir_only and not is_dir:
+                continue
+            if anchored:
+                target = path[len(base):].lstrip(os.sep)
+            else:
+                target = os.path.basename(path)
+            if glob.match(target):
+                ignored = not negated
+        return ignored
+
+
+def required_literals(patterns, options, lower=True):
+    """Return the strings a matching line must hold, as a list of
+    alternatives, the line holds all the strings of at least one of
+    them. An empty list is returned if some pattern can match without
+    any string, or can not be parsed. The strings are lowercased,
+    unless lower is False.
+    """
+    alternatives = []
+    for pattern in patterns:
+        if 'fixed_strings' in options:
+            alternatives.append([pattern.encode()])
+            continue
+        try:
+            parsed = sre_parse.parse(pattern.encode())
+        except re.error:
+            return []
+        items = list(parsed)
+        if len(items) == 1 and items[0][0] is sre_parse.BRANCH:
+            for branch in items[0][1][1]:
+                alternatives.append(sequence_literals(branch))
+        else:
+            alternatives.append(sequence_literals(items))
+    if not all(alternatives):
+        return []
+    if not lower:
+        return alternatives
+    return [[x.lower() for x in alt] for alt in alternatives]
+
+
+def sequence_literals(items):
+    """Return the strings required by a sequence of parsed items,
+    every run of literals, along with the strings required by the
+    groups and the repeats that occur at least once.
+    """
+    repeats = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+               getattr(sre_parse, 'POSSESSIVE_REPEAT', None))
+    literals = []
+    run = bytearray()
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(av)
+            continue
+        if run:
+            literals.append(bytes(run))
+            run = bytearray()
+        if op is sre_parse.SUBPATTERN:
+            sub = list(av[-1])
+            if not (len(sub) == 1 and sub[0][0] is sre_parse.BRANCH):
+                literals.extend(sequence_literals(sub))
+        elif op in repeats and av[0] >= 1:
+            literals.extend(sequence_literals(av[2]))
+    if run:
+        literals.append(bytes(run))
+    return literals
+
+
+class TrigramIndex:
+
+    """An index of the trigrams of the files, kept in an SQLite
+    database under a directory, to pass over the files that can not
+    hold the strings a pattern requires. Each file has a signature, a
+    bitmap with a bit set for every trigram of its lowercased data,
+    along with the size and the modification time it was built for.
+    The signature of a file is rebuilt as soon as either of them
+    changes, so the index is built and updated along the searches. A
+    file with too many distinct trigrams gets no signature, it is
+    always searched. The signatures of the decompressed data of the
+    --decompress option are kept in a table of their own.
+
+    SQLite does the locking, several processes may update the index
+    at the same time.
+    """
+
+    # bits of a signature per trigram, a trigram absent from a file
+    # hits a set bit by chance with a probability of about 1/8.
+    bits_per_trigram = 8
+
+    # beyond this number of distinct trigrams a file is searched anyway
+    max_trigrams = 1 << 18
+
+    # files updated in a transaction
+    batch = 256
+
+    block = 1 << 20
+
+    def __init__(self, path, decompress=False):
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'trigrams.db'),
+                                  timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.table = 'decompressed' if decompress else 'files'
+        self.opener = functools.partial(open_file, decompress=decompress)
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s ('
+                        'path TEXT PRIMARY KEY, size INTEGER, '
+                        'mtime INTEGER, signature BLOB)' % self.table)
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def select(self, names, alternatives, status_list):
+        """Generate the names that may hold all the strings of one of
+        the alternatives. For each file passed over, a False is added
+        to status_list, as if it was searched without a match.
+        """
+        queries = [set().union(*(self.trigrams(x) for x in alt if len(x) > 2))
+                   for alt in alternatives]
+        if not all(queries):
+            yield from names
+            return
+        for name in names:
+            sig = self.lookup(name)
+            if sig is None or any(self.holds(sig, q) for q in queries):
+                yield name
+            else:
+                status_list.append(False)
+
+    def lookup(self, name):
+        """Return the signature of a file, None if it has none"""
+        try:
+            st = os.stat(name)
+        except OSError:
+            return None
+        path = os.path.abspath(name)
+        row = self.db.execute('SELECT size, mtime, signature FROM %s '
+                              'WHERE path = ?' % self.table,
+                              (path,)).fetchone()
+        if row and row[:2] == (st.st_size, st.st_mtime_ns):
+            return row[2]
+        try:
+            sig = self.build(self.opener(name))
+        except OSError:
+            return None
+        self.db.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)'
+                        % self.table, (path, st.st_size, st.st_mtime_ns, sig))
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.db.commit()
+            self.pending = 0
+        return sig
+
+    def build(self, file):
+        """Read the file through, return the signature of its
+        trigrams, None if there are too many of them.
+        """
+        grams = set()
+        tail = b''
+        try:
+            while True:
+                chunk = file.read(self.block)
+                if not chunk:
+                    break
+                data = tail + chunk.lower()
+                grams |= self.trigrams(data)
+                if len(grams) > self.max_trigrams:
+                    return None
+                tail = data[-2:]
+        finally:
+            file.close()
+        m = 64
+        while m < len(grams) * self.bits_per_trigram:
+            m <<= 1
+        # set a byte of b'0' or b'1' for each bit, then read the
+        # bytes as a binary number, the lowest bit comes last.
+        slots = bytearray(b'0') * m
+        ones = itertools.repeat(ord('1'))
+        collections.deque(map(slots.__setitem__,
+                              self.positions(grams, m), ones), maxlen=0)
+        slots.reverse()
+        return int(slots, 2).to_bytes(m // 8, 'little')
+
+    def holds(self, sig, grams):
+        """Tell if all the trigrams may be in the file of the signature"""
+        return all(sig[p >> 3] >> (p & 7) & 1
+                   for p in self.positions(grams, len(sig) * 8))
+
+    def positions(self, grams, m):
+        """Map the trigrams to bits of a signature of m bits, a power
+        of 2, by multiplicative hashing. The loop runs in C.
+        """
+        shift = 32 - m.bit_length() + 1
+        hashed = map(operator.mul, grams, itertools.repeat(0x9e3779b1))
+        hashed = map(operator.and_, hashed, itertools.repeat(0xffffffff))
+        return map(operator.rshift, hashed, itertools.repeat(shift))
+
+    def trigrams(self, data):
+        """Return the trigrams of data as integers. The data is cast
+        to arrays of 4-byte integers at each of the 4 offsets, which
+        yields the 4-grams at every position without a loop in
+        Python, the trigrams are cut from the distinct ones.
+        """
+        padded = data + b'\0'
+        view = memoryview(padded)
+        quads = set()
+        for k in range(4):
+            n = (len(padded) - k) // 4 * 4
+            if n > 0:
+                quads.update(view[k:k+n].cast('I'))
+        view.release()
+        if len(data) < 3:
+            return set()
+        if sys.byteorder == 'little':
+            return set(map(operator.and_, quads, itertools.repeat(0xffffff)))
+        return set(map(operator.rshift, quads, itertools.repeat(8)))
+
+
+class ResultCache:
+
+    """The status and the output of the searches of regular files,
+    kept in an SQLite database under a directory. An entry is keyed by
+    the name, device, inode, size and modification time of the file,
+    along with the pattern and the options that shape the output. A
+    file that changes gets a new key, so it is searched again, and its
+    old entry ages out. The least recently used entries are evicted
+    once the outputs grow beyond the limit in total.
+
+    SQLite does the locking, several processes may share the cache.
+    """
+
+    # the options that have no effect on the output of a file
+    ignored = frozenset(['jobs', 'keep_order', 'async_reads', 'index',
+                         'cache', 'cache_size', 'recursive', 'drecursive',
+                         'include', 'exclude', 'exclude_dir', 'gitignore',
+                         'skip_duplicates'])
+
+    # entries updated in a transaction
+    batch = 256
+
+    # the eviction goes down to this share of the limit, so that the
+    # next entries kept do not run it again at once.
+    low_water = 0.9
+
+    def __init__(self, path, limit):
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'results.db'),
+                                  timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        'key TEXT PRIMARY KEY, status INTEGER, '
+                        'output BLOB, size INTEGER, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_used '
+                        'ON results (used)')
+        self.db.commit()
+        self.limit = limit
+        self.total = self.total_size()
+        self.pending = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def key(self, name, pattern, options):
+        """Return the key of the file, None if it is not a regular
+        file, or can not be told. A file larger than the whole cache
+        has no key either, its output is unlikely to be kept.
+        """
+        try:
+            st = os.stat(name)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self.limit:
+            return None
+        shaping = sorted((k, v) for k, v in options.items()
+                         if k not in self.ignored)
+        ident = repr((name, st.st_dev, st.st_ino, st.st_size,
+                      st.st_mtime_ns, pattern, shaping))
+        return hashlib.sha1(ident.encode('utf-8', 'surrogateescape')
+                            ).hexdigest()
+
+    def get(self, key):
+        """Return the status and the output kept for the key, None if
+        there are none.
+        """
+        row = self.db.execute('SELECT status, output FROM results '
+                              'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE results SET used = ? WHERE key = ?',
+                        (time.time(), key))
+        self.updated()
+        return bool(row[0]), row[1]
+
+    def put(self, key, status, output):
+        """Keep the status and the output for the key, an output
+        larger than the whole cache is not kept.
+        """
+        size = len(key) + len(output)
+        if size > self.limit:
+            return
+        self.db.execute('INSERT OR REPLACE INTO results VALUES '
+                        '(?, ?, ?, ?, ?)',
+                        (key, int(status), output, size, time.time()))
+        self.total += size
+        if self.total > self.limit:
+            self.evict()
+        self.updated()
+
+    def evict(self):
+        """Remove the least recently used entries until the outputs fit
+        in the low water mark of the limit, a batch of them fetched at a
+        time. Other processes may have added theirs, the total is summed
+        up again.
+        """
+        self.total = self.total_size()
+        target = self.limit * self.low_water
+        while self.total > target:
+            rows = self.db.execute('SELECT key, size FROM results '
+                                   'ORDER BY used LIMIT ?',
+                                   (self.batch,)).fetchall()
+            if not rows:
+                break
+            victims = []
+            for key, size in rows:
+                if self.total <= target:
+                    break
+                victims.append((key,))
+                self.total -= size
+            self.db.executemany('DELETE FROM results WHERE key = ?', victims)
+
+    def total_size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) '
+                               'FROM results').fetchone()[0]
+
+    def updated(self):
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.db.commit()
+            self.pending = 0
+
+
+class SpillBuffer(io.BytesIO):
+
+    """The output of a search kept in memory for the cache, until it
+    grows beyond limit. It is then written on to ofile, and so is the
+    rest of it as it comes: an output that large is not kept anyway.
+    """
+
+    def __init__(self, ofile, limit):
+        super(SpillBuffer, self).__init__()
+        self.ofile = ofile
+        self.limit = limit
+        self.spilled = False
+
+    def write(self, data):
+        if self.spilled:
+            return self.ofile.write(data)
+        n = super(SpillBuffer, self).write(data)
+        if self.tell() > self.limit:
+            self.spill()
+        return n
+
+    def writelines(self, lines):
+        if self.spilled:
+            return self.ofile.writelines(lines)
+        super(SpillBuffer, self).writelines(lines)
+        if self.tell() > self.limit:
+            self.spill()
+
+    def flush(self):
+        if self.spilled:
+            self.ofile.flush()
+
+    def spill(self):
+        self.ofile.write(self.getbuffer())
+        self.seek(0)
+        self.truncate()
+        self.spilled = True
+
+
+def recursive_walk(worker, names, pattern, options, processor=None):
     """Process all regular files, descend into directories. When
     the -q option is provided, the first match will trigger an
     exception named GrepStatusDetermined."""
 
-    def processor(names, pattern, options, worker):
+    file_processor = processor or serial_processor
+    walker = TreeWalker(options)
+
+    # with --index, the files that can not match are passed over,
+    # unless the files without a match have output of their own.
+    alternatives = []
+    if 'index' in options and not set(options) & set(
+            ['invert', 'count', 'files_without_match']):
+        patterns = [pattern] if isinstance(pattern, str) else pattern
+        alternatives = required_literals(patterns, options)
+
+    def dir_processor(names, pattern, options, worker):
         status_list = []
-        for name in names:
-            if os.path.isfile(name):
-                status = worker(name, pattern, options)
-                status_list.append(status)
-            elif os.path.isdir(name):
-                try:
-                    sub_names = os.listdir(name)
-                except Exception as e:
-                    print(str(e), file=sys.stderr)
-                    status_list.append(False)
-                else:
-                    sub_names = [os.path.join(name, x) for x in sub_names]
-                    names.extend(sub_names)
+        files = walker.walk(names, status_list)
+        if not alternatives:
+            status_list.extend(file_processor(files, pattern, options, worker))
+            return status_list
+        index = TrigramIndex(options['index'], 'decompress' in options)
+        try:
+            files = index.select(files, alternatives, status_list)
+            status_list.extend(file_processor(files, pattern, options, worker))
+        finally:
+            index.close()
         return status_list
 
-    return walk(worker, names, pattern, options, processor)
+    return walk(worker, names, pattern, options, dir_processor)
 
 
 def walk(worker, names, pattern, options, processor=None):
@@ -848,12 +2849,7 @@ def walk(worker, names, pattern, options, processor=None):
     provided, the first match will trigger an exception named
     GrepStatusDetermined."""
     if not processor:
-        def processor(names, pattern, options, worker):
-            status_list = []
-            for name in names:
-                status = worker(name, pattern, options)
-                status_list.append(status)
-            return status_list
+        processor = serial_processor
 
     try:
         status_list = processor(names, pattern, options, worker)
@@ -864,3 +2860,231 @@ def walk(worker, names, pattern, options, processor=None):
         return any(status_list)
     else:
         return all(status_list)
+
+
+def serial_processor(names, pattern, options, worker):
+    """Process the files one by one"""
+    status_list = []
+    for name in names:
+        status = worker(name, pattern, options)
+        status_list.append(status)
+    return status_list
+
+
+def make_pool_processor(jobs, pool_worker, ofile, keep_order=False,
+                        splitter=None, split_worker=None, batch=64):
+    """Return a processor that sends the files to a pool of 'jobs'
+    processes. pool_worker(names, pattern, options) is run in the pool,
+    it returns the statuses and the output of the files, the output is
+    written to ofile as a whole, in the order of completion, or in
+    the order of the names if keep_order is True. The standard input
+    is processed by the worker of this process.
+
+    The names are sent 'batch' at a time, sending a small file alone
+    costs this process more than the search of it costs the pool.
+    While fewer than 'jobs' batches are in flight, a name is sent at
+    once, so that a few files are still spread over the pool.
+
+    A file that splitter(name, options) cuts into segments, a large
+    one, is searched by split_worker(pool, name, segments, pattern,
+    options) on the same pool, once the files before it are done.
+
+    GrepStatusDetermined raised in the pool is raised again here, the
+    files not yet started are cancelled.
+    """
+
+    def processor(names, pattern, options, worker):
+        status_list = []
+        pending = collections.deque()
+
+        def collect():
+            """Write out the finished ones, wait for at least one"""
+            if keep_order:
+                done = [pending.popleft()]
+                while pending and pending[0].done():
+                    done.append(pending.popleft())
+            else:
+                done, not_done = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                pending.clear()
+                pending.extend(not_done)
+            for future in done:
+                statuses, data = future.result()
+                ofile.write(data)
+                status_list.extend(statuses)
+
+        def submit():
+            """Send the names gathered to the pool"""
+            if gathered:
+                pending.append(pool.submit(pool_worker, gathered[:],
+                                           pattern, options))
+                gathered.clear()
+
+        gathered = []
+        with futures.ProcessPoolExecutor(jobs) as pool:
+            try:
+                for name in names:
+                    segments = splitter(name, options) if splitter else None
+                    if segments or name == '-':
+                        submit()
+                        while pending:
+                            collect()
+                        if segments:
+                            status = split_worker(pool, name, segments,
+                                                  pattern, options)
+                        else:
+                            status = worker(name, pattern, options)
+                        status_list.append(status)
+                        continue
+                    gathered.append(name)
+                    if len(gathered) >= batch or len(pending) < jobs:
+                        submit()
+                    # keep a bounded number of batches in flight
+                    if len(pending) >= jobs * 4:
+                        collect()
+                submit()
+                while pending:
+                    collect()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        return status_list
+
+    return processor
+
+
+def split_file(file, count):
+    """Return the (start, stop) offsets of about count segments of the
+    file, each of whole lines, so that they can be searched apart.
+    The cuts are moved forward to the next newline, found by pread,
+    a line longer than a segment leaves fewer of them.
+    """
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        bounds = [0]
+        for i in range(1, count):
+            pos = max(size * i // count - 1, bounds[-1])
+            while pos < size:
+                block = os.pread(fd, 1 << 16, pos)
+                if not block:
+                    pos = size
+                    break
+                idx = block.find(b'\n')
+                if idx >= 0:
+                    pos += idx + 1
+                    break
+                pos += len(block)
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+        bounds.append(size)
+    finally:
+        os.close(fd)
+    return list(zip(bounds, bounds[1:]))
+
+
+def count_newlines(file, start, stop, piece=1 << 20):
+    """Count the newlines of the file in [start, stop), the line
+    numbers of a segment follow from those before it. The file is
+    read a piece at a time by pread.
+    """
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        total = 0
+        while start < stop:
+            data = os.pread(fd, min(piece, stop - start), start)
+            if not data:
+                break
+            total += data.count(b'\n')
+            start += len(data)
+        return total
+    finally:
+        os.close(fd)
+
+
+def make_async_processor(concurrency, buffer_worker, reader, batch=16):
+    """Return a processor for a great many small files, whose time goes
+    to opening and reading rather than searching. reader(name) is run
+    by a pool of 'concurrency' threads, a bounded number of files are
+    opened and read ahead while the data read is searched in the event
+    loop by buffer_worker(name, data, pattern, options), one file after
+    another in the order of the names. The output of a file is never
+    mixed with others. A file that reader fails on, or leaves to the
+    worker by returning None, as for a large file, is searched by the
+    worker as usual, and so is the standard input.
+
+    The files are handed to the threads 'batch' at a time, waking up
+    the event loop once per file would cost more than a small file
+    takes to read.
+    """
+
+    # imported here, it takes longer to import than a small search
+    import asyncio
+
+    def read_batch(names):
+        found = []
+        for name in names:
+            try:
+                found.append((name, reader(name)))
+            except Exception:
+                found.append((name, None))
+        return found
+
+    async def drive(names, pattern, options, worker):
+        loop = asyncio.get_event_loop()
+        status_list = []
+        pending = collections.deque()
+        names_read = []
+
+        def submit():
+            future = loop.run_in_executor(pool, read_batch, names_read[:])
+            pending.append(future)
+            names_read.clear()
+
+        async def collect():
+            """Search the files read first, wait for them if need be"""
+            for name, data in await pending.popleft():
+                if data is None:
+                    status = worker(name, pattern, options)
+                else:
+                    status = buffer_worker(name, data, pattern, options)
+                status_list.append(status)
+
+        with futures.ThreadPoolExecutor(concurrency) as pool:
+            try:
+                for name in names:
+                    if name == '-':
+                        if names_read:
+                            submit()
+                        while pending:
+                            await collect()
+                        status_list.append(worker(name, pattern, options))
+                        continue
+                    names_read.append(name)
+                    if len(names_read) == batch:
+                        submit()
+                    # keep a bounded number of files in flight
+                    if len(pending) >= concurrency * 2:
+                        await collect()
+                if names_read:
+                    submit()
+                while pending:
+                    await collect()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        return status_list
+
+    def processor(names, pattern, options, worker):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                    drive(names, pattern, options, worker))
+        finally:
+            loop.close()
+
+    return processor
@@ -1,7 +1,13 @@
 import os
 import sys
+import bz2
+import gzip
+import lzma
+import json
+import sqlite3
+import base64
 from subprocess import Popen, PIPE
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 import pexpect
 
@@ -9,6 +15,7 @@ BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__name__), '..'))
 sys.path.insert(0, BASEDIR)
 
 from grep import Grep
+from lib import GrepWorker, ResultCache
 
 
 class Mixin:
@@ -114,6 +121,26 @@ class TestGrep(Mixin):
         correct_data = self.get_correct_data('grep', args)
         assert read_data == correct_data
 
+    def test_files_without_match(self):
+        """ -l and -L options, with and without -v """
+        top = TemporaryDirectory()
+        names = []
+        for n, text in enumerate(['a\nb\n', 'c\n', 'a\n', '', 'b\na']):
+            name = os.path.join(top.name, str(n))
+            with open(name, 'w') as f:
+                f.write(text)
+            names.append(name)
+        for opts in ['-l', '-L', '-lv', '-Lv']:
+            for pat in ['a', 'a$', '^', '[bc]']:
+                self.setup_method()
+                app = Grep(output_file=self.ofile)
+                args = [opts, pat] + names
+                app.run(args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', args)
+                assert read_data == correct_data
+        top.cleanup()
+
     def test_line_number(self):
         """ -n option """
         app = Grep(output_file=self.ofile)
@@ -132,6 +159,17 @@ class TestGrep(Mixin):
         correct_data = self.get_correct_data('grep', args)
         assert read_data == correct_data
 
+    def test_count_invert(self):
+        """ -c with -v options """
+        for pat in ['God', 'the fi[a-z]+', '^$', 'x']:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = ['-vc', pat, self.ifile_name]
+            app.run(args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', ['-E'] + args)
+            assert read_data == correct_data
+
     def test_only_matching(self):
         """ -o option """
         app = Grep(output_file=self.ofile)
@@ -150,6 +188,84 @@ class TestGrep(Mixin):
         correct_data = self.get_correct_data('grep', args)
         assert read_data == correct_data
 
+    def test_fixed_strings(self):
+        """ -F option """
+        for opts in ['-F', '-Fo', '-Fn', '-Fi', '-Fio']:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = [opts, '[it was]', self.ifile_name]
+            app.run(args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', args)
+            assert read_data == correct_data
+
+    def test_literal_ignore_case_word(self):
+        """ plain string with -i and -w options """
+        for opts in ['-iw', '-iwo', '-io', '-wc']:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = [opts, 'HEAVEN', self.ifile_name]
+            app.run(args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', args)
+            assert read_data == correct_data
+
+    def test_multiple_patterns(self):
+        """ -e option """
+        for opts in ['-n', '-o', '-c', '-A1']:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = [opts, '-e', 'waters?', '-e', 'God', '-e', 'Go',
+                    self.ifile_name]
+            app.run(args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', ['-E'] + args)
+            assert read_data == correct_data
+
+    def test_pattern_flags(self):
+        """ -e option, a pattern that sets its own flags """
+        for opts in [['-n'], ['-o'], ['-c'], ['-w']]:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            app.run(opts + ['-e', '(?i)WATERS?', '-e', 'God', self.ifile_name])
+            read_data = self.get_result()
+            args = opts + ['-E', '-e', '[Ww][Aa][Tt][Ee][Rr][Ss]?', '-e',
+                           'God', self.ifile_name]
+            correct_data = self.get_correct_data('grep', args)
+            assert read_data == correct_data
+
+    def test_pattern_file(self):
+        """ -f option, a large set of plain strings """
+        text = open(self.ifile_name).read()
+        words = sorted(set(x for x in text.split() if x.isalpha()))
+        words += ['not-exist-%s' % n for n in range(400)]
+        pfile_name = NamedTemporaryFile().name
+        with open(pfile_name, 'w') as f:
+            f.write('\n'.join(words[::3]) + '\n')
+        for opts in ['-n', '-o', '-io', '-c', '-l', '-B1']:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = [opts, '-f', pfile_name, '-e', 'fif+th', self.ifile_name]
+            app.run(args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', ['-E'] + args)
+            assert read_data == correct_data
+        os.unlink(pfile_name)
+
+    def test_color(self):
+        """ --color option """
+        colored = GrepWorker.c_match + b'God' + GrepWorker.c_off
+        for pat in ['God', 'G[o]d', '(?<= )God']:
+            for opts in [[], ['-o'], ['-i']]:
+                self.setup_method()
+                app = Grep(output_file=self.ofile)
+                args = opts + [pat, self.ifile_name]
+                app.run(['--color=always'] + args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', opts +
+                                                     ['God', self.ifile_name])
+                assert read_data == correct_data.replace(b'God', colored)
+
     def test_with_filename(self):
         """ -H option """
         app = Grep(output_file=self.ofile)
@@ -204,6 +320,26 @@ class TestGrep(Mixin):
         correct_data = self.get_correct_data('grep', args)
         assert read_data == correct_data
 
+    def test_invert(self):
+        """ -v option """
+        app = Grep(output_file=self.ofile)
+        args = ['-nv', 'God', self.ifile_name]
+        app.run(args)
+        read_data = self.get_result()
+        correct_data = self.get_correct_data('grep', args)
+        assert read_data == correct_data
+
+    def test_line_anchors(self):
+        """ ^ and $ match at the boundary of each line in a chunk """
+        for pat in ['^And God said', 'day[.]$', '^$']:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = ['-n', pat, self.ifile_name]
+            app.run(args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', args)
+            assert read_data == correct_data
+
     def test_block_size_fname(self):
         app = Grep(bs=1, output_file=self.ofile)
         args = ['-l', 'water', self.ifile_name]
@@ -220,6 +356,194 @@ class TestGrep(Mixin):
         correct_data = self.get_correct_data('grep', args)
         assert read_data == correct_data
 
+    def test_block_size_newline(self):
+        """ a pattern that may match a newline gives the same lines
+        whatever the block size, as if searched one line at a time """
+        for pat in ['[^.]$', r'\W$', r'earth\W', r'\s$', r'\D\n']:
+            for opts in ['-n', '-c', '-vn', '-l']:
+                results = []
+                for bs in [1, 200, 8192]:
+                    self.setup_method()
+                    app = Grep(bs=bs, output_file=self.ofile)
+                    app.run([opts, pat, self.ifile_name])
+                    results.append(self.get_result())
+                assert results[1] == results[0]
+                assert results[2] == results[0]
+
+    def test_carriage_return(self):
+        """ a carriage return inside a line does not end it """
+        name = NamedTemporaryFile().name
+        with open(name, 'wb') as f:
+            f.write(b'x1\na\rx2\n' * 50 + b'foo\rfoo\nx\x0cfoo\nbar\n' * 50)
+        for bs in [1, 8192]:
+            for opts in ['-n', '-vn', '-bn', '-on', '-c', '-vc', '-nA1',
+                         '-nB1', '-nC2', '-m3', '-nA1 -m2']:
+                for pat in ['x', 'foo']:
+                    self.setup_method()
+                    app = Grep(bs=bs, output_file=self.ofile)
+                    args = opts.split() + [pat, name]
+                    app.run(args)
+                    read_data = self.get_result()
+                    correct_data = self.get_correct_data('grep', args)
+                    assert read_data == correct_data
+        os.unlink(name)
+
+    def test_newline_excluded(self):
+        """ a pattern that may match a newline never matches the one
+        ending a line, with or without -o """
+        name = NamedTemporaryFile().name
+        with open(name, 'wb') as f:
+            f.write(b'abc \nabc\n  \nx\ty\n\nlast \t\nend\n' * 50)
+        for bs in [1, 8192]:
+            for opts in ['-n', '-vn', '-on', '-bo', '-c', '-vc', '-l',
+                         '-nA1']:
+                for pat in [r'\s$', r'\s', '[^a]$', r'^\s*$', r'\S$']:
+                    self.setup_method()
+                    app = Grep(bs=bs, output_file=self.ofile)
+                    args = opts.split() + [pat, name]
+                    app.run(args)
+                    read_data = self.get_result()
+                    correct_data = self.get_correct_data('grep', args)
+                    assert read_data == correct_data
+        os.unlink(name)
+
+    def test_block_size_invert(self):
+        app = Grep(bs=1, output_file=self.ofile)
+        args = ['-vn', 'water', self.ifile_name]
+        app.run(args)
+        read_data = self.get_result()
+        correct_data = self.get_correct_data('grep', args)
+        assert read_data == correct_data
+
+    def test_invert_regions(self):
+        """ -v option, the lines between the hits written as they are """
+        for bs in [1, 200, 8192]:
+            for pat in ['water', 'God', 'the', 'not-exist']:
+                self.setup_method()
+                app = Grep(bs=bs, output_file=self.ofile)
+                args = ['-v', pat, self.ifile_name]
+                app.run(args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', args)
+                assert read_data == correct_data
+
+    def test_invert_density(self):
+        """ -v option, the hits from sparse to dense over many runs of
+        lines probed, the lines between them written in one piece """
+        name = NamedTemporaryFile().name
+        with open(name, 'w') as f:
+            for n in range(5000):
+                words = ['w%d' % k for k in [100, 10, 4, 2] if n % k == 0]
+                f.write(' '.join(['line'] + words + ['%d\n' % n]))
+        for bs in [200, 8192]:
+            for pat in ['w100', 'w10', 'w4', 'w2', 'line']:
+                self.setup_method()
+                app = Grep(bs=bs, output_file=self.ofile)
+                args = ['-v', pat, name]
+                app.run(args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', args)
+                assert read_data == correct_data
+        os.unlink(name)
+
+    def test_byte_offset(self):
+        """ -b option """
+        for bs in [1, 200, 8192]:
+            for opts in ['-b', '-bn', '-bo', '-bv', '-bB1', '-bA2', '-boA1']:
+                self.setup_method()
+                app = Grep(bs=bs, output_file=self.ofile)
+                args = [opts, 'God', self.ifile_name]
+                app.run(args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', args)
+                assert read_data == correct_data
+
+    def test_json(self):
+        """ --json option, the records agree with -nb """
+        for bs in [1, 8192]:
+            for opts in [[], ['-v'], ['-B1'], ['-A2']]:
+                self.setup_method()
+                app = Grep(bs=bs, output_file=self.ofile)
+                args = opts + ['God', self.ifile_name]
+                app.run(['--json'] + args)
+                read_data = []
+                for record in self.get_result().splitlines():
+                    r = json.loads(record.decode())
+                    sep = ':' if r['type'] == 'match' else '-'
+                    read_data.append('%d%s%d%s%s' % (r['line_number'], sep,
+                                     r['byte_offset'], sep, r['line']))
+                    for start, end in r.get('submatches', []):
+                        assert r['line'][start:end] == 'God'
+                correct_data = self.get_correct_data('grep', ['-nb'] + args)
+                correct_data = [x for x in correct_data.decode().splitlines()
+                                if x != '--']
+                assert read_data == correct_data
+
+    def test_json_bytes(self):
+        """ --json option, a line that is not UTF-8 as base64 bytes and
+        a binary file as a record of its own """
+        name = NamedTemporaryFile().name
+        with open(name, 'wb') as f:
+            f.write(b'caf\xe9 God\nGod\n')
+        bname = NamedTemporaryFile().name
+        with open(bname, 'wb') as f:
+            f.write(b'God\0created\n')
+        app = Grep(output_file=self.ofile)
+        app.run(['--json', 'God', name, bname])
+        records = [json.loads(x.decode('utf-8'))
+                   for x in self.get_result().splitlines()]
+        assert base64.b64decode(records[0]['bytes']) == b'caf\xe9 God'
+        assert 'line' not in records[0]
+        assert records[0]['submatches'] == [[5, 8]]
+        assert records[1]['line'] == 'God'
+        assert records[2] == {'type': 'binary', 'file': bname}
+        os.unlink(name)
+        os.unlink(bname)
+
+    def test_windows(self):
+        """ large regular files are read in windows """
+        mfile_name = NamedTemporaryFile().name
+        with open(self.ifile_name) as f:
+            text = f.read()
+        with open(mfile_name, 'w') as f:
+            f.write(text * (GrepWorker.window_threshold // len(text) + 2))
+        for opts in ['-n', '-c', '-vn', '-o', '-B1', '-in']:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = [opts, 'the fi[a-z]+', mfile_name]
+            app.run(args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', ['-E'] + args)
+            assert read_data == correct_data
+        os.unlink(mfile_name)
+
+    def test_window_truncated(self):
+        """ a file truncated while being searched in windows """
+        mfile_name = NamedTemporaryFile().name
+        with open(self.ifile_name) as f:
+            text = f.read()
+        with open(mfile_name, 'w') as f:
+            f.write(text * (GrepWorker.window_threshold // len(text) + 2))
+
+        class Worker(GrepWorker):
+            window_size = 8192
+            def scan(self, buf, pos, end):
+                if self.buf_offset:
+                    os.truncate(mfile_name, 20000)
+                super().scan(buf, pos, end)
+
+        options = {'color': 'never', 'with_filename': False}
+        with open(mfile_name, 'rb') as ifile:
+            Worker('God', options, ifile, self.ofile).run()
+            assert ifile.tell() == 20000
+        self.ofile.close()
+        read_data = self.get_result()
+        with open(mfile_name, 'rb') as f:
+            data = f.read()
+        correct_data = b''.join(x for x in data.splitlines(True) if b'God' in x)
+        assert read_data == correct_data
+        os.unlink(mfile_name)
+
     def test_after(self):
         """ -A option """
         app = Grep(output_file=self.ofile)
@@ -264,6 +588,114 @@ class TestGrep(Mixin):
         correct_data = self.get_correct_data('grep', args)
         assert read_data == correct_data
 
+    def test_context_block_size(self):
+        """ -A and -B options, context across chunks """
+        for bs in [1, 200, 8192]:
+            for opts in ['-nA2', '-nB4', '-C1', '-nvC2']:
+                self.setup_method()
+                app = Grep(bs=bs, output_file=self.ofile)
+                args = [opts, 'Heaven|fifth|sixth', self.ifile_name]
+                app.run(args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', ['-E'] + args)
+                assert read_data == correct_data
+
+    def test_only_matching_block_size(self):
+        """ -o option, matches across chunks and lines """
+        for bs in [1, 200, 8192]:
+            for opts in ['-o', '-no', '-nom3', '-io']:
+                for pat in ['G(o)d', 'the|e[a-z]*', 'd\\s+t', 'x*']:
+                    self.setup_method()
+                    app = Grep(bs=bs, output_file=self.ofile)
+                    args = [opts, pat, self.ifile_name]
+                    app.run(args)
+                    read_data = self.get_result()
+                    correct_data = self.get_correct_data('grep', ['-E'] + args)
+                    assert read_data == correct_data
+
+    def test_prefilter(self):
+        """ patterns searched around the strings they require """
+        for bs in [1, 200, 8192]:
+            for pat in ['[A-Z][a-z]+ God', 'the (heaven|earth)',
+                        'waters?[^ ]* from', 'x*fif+th']:
+                for opts in ['-n', '-i', '-c', '-o', '-v']:
+                    self.setup_method()
+                    app = Grep(bs=bs, output_file=self.ofile)
+                    args = [opts, pat, self.ifile_name]
+                    app.run(args)
+                    read_data = self.get_result()
+                    correct_data = self.get_correct_data('grep', ['-E'] + args)
+                    assert read_data == correct_data
+
+    def test_binary_files(self):
+        """ --binary-files, -I and -a options """
+        name = NamedTemporaryFile().name
+        with open(name, 'wb') as f:
+            f.write(b'God\0created\nthe heaven\n')
+        expected = {(): b'Binary file %s matches\n' % name.encode(),
+                    ('-a',): b'God\0created\n',
+                    ('-I',): b'',
+                    ('--binary-files=without-match',): b'',
+                    ('-c',): b'1\n',
+                    ('-v',): b'Binary file %s matches\n' % name.encode(),
+                    ('-Ic',): b'0\n',
+                    ('-IL',): name.encode() + b'\n'}
+        for opts, data in expected.items():
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = list(opts) + ['God', name]
+            app.run(args)
+            read_data = self.get_result()
+            assert read_data == data
+        os.unlink(name)
+
+    def test_decompress(self):
+        """ --decompress option """
+        with open(self.ifile_name, 'rb') as f:
+            text = f.read()
+        top = TemporaryDirectory()
+        for module in [gzip, bz2, lzma]:
+            name = os.path.join(top.name, module.__name__)
+            with module.open(name, 'wb') as f:
+                f.write(text)
+        for opts in ['-n', '-c', '-vB1']:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = ['-R', '-h', opts, 'water']
+            app.run(args + ['--decompress', top.name])
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', args[1:] +
+                                                 [self.ifile_name])
+            assert read_data == correct_data * 3
+        top.cleanup()
+
+    def test_max_count(self):
+        """ -m option """
+        for bs in [1, 8192]:
+            for opts in ['-m2', '-nm3', '-cm4', '-vcm5', '-vnm2',
+                         '-m2', '-m3 -A2', '-m2 -C1', '-m2 -vA1']:
+                self.setup_method()
+                app = Grep(bs=bs, output_file=self.ofile)
+                args = opts.split() + ['light', self.ifile_name]
+                app.run(args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', args)
+                assert read_data == correct_data
+
+    def test_max_count_offset(self):
+        """ -m option leaves the input file past the last selected line """
+        script = os.path.join(BASEDIR, 'grep.py')
+        for opts in ['-m2', '-m2 -A3', '-vm4', '-cm3']:
+            args = opts.split() + ['God']
+            outputs = []
+            for cmd in [[sys.executable, script], ['grep']]:
+                with open(self.ifile_name, 'rb') as f:
+                    # not /dev/null, GNU grep stops at once writing to it
+                    p = Popen(['sh', '-c', '"$@" >%s; cat' % self.ofile_name,
+                               'sh'] + cmd + args, stdin=f, stdout=PIPE)
+                    outputs.append(p.communicate()[0])
+            assert outputs[0] == outputs[1]
+
     def test_quiet(self):
         """ -q option """
         for pat in ['water', 'not exist water']:
@@ -284,9 +716,254 @@ class TestGrep(Mixin):
         correct_data = sorted(self.get_correct_data('grep', args))
         assert read_data == correct_data
 
+    def test_include_exclude(self):
+        """ --include, --exclude and --exclude-dir options """
+        for opts in [['--include=*.h'], ['--exclude=e*'],
+                     ['--exclude-dir=symbols'],
+                     ['--include=*us*', '--exclude=de*']]:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = ['-R'] + opts + ['colemak', '/usr/share/X11/xkb']
+            app.run(args)
+            read_data = sorted(self.get_result())
+            correct_data = sorted(self.get_correct_data('grep', args))
+            assert read_data == correct_data
+
+    def test_gitignore(self):
+        """ --gitignore option """
+        top = TemporaryDirectory()
+        for name in ['a/b', 'build', '.git', 'c']:
+            os.makedirs(os.path.join(top.name, name))
+        for name in ['x.txt', 'x.log', 'a/y.txt', 'a/b/z.log',
+                     'a/b/keep.log', 'build/o.txt', '.git/HEAD', 'c/w.txt']:
+            with open(os.path.join(top.name, name), 'w') as f:
+                f.write('hello\n')
+        with open(os.path.join(top.name, '.gitignore'), 'w') as f:
+            f.write('*.log\n!keep.log\nbuild/\n/c\n')
+        with open(os.path.join(top.name, 'a', '.gitignore'), 'w') as f:
+            f.write('y.txt\n')
+        app = Grep(output_file=self.ofile)
+        app.run(['-Rl', '--gitignore', 'hello', top.name])
+        read_data = sorted(self.get_result().splitlines())
+        correct_data = [os.path.join(top.name, x).encode()
+                        for x in ['a/b/keep.log', 'x.txt']]
+        assert read_data == correct_data
+        top.cleanup()
+
+    def test_symlinks(self):
+        """ -r, -R and --skip-duplicates options on links and loops """
+        top = TemporaryDirectory()
+        for name in ['a/b', 'c']:
+            os.makedirs(os.path.join(top.name, name))
+        for name in ['a/f', 'a/b/g', 'c/h']:
+            with open(os.path.join(top.name, name), 'w') as f:
+                f.write('hello\n')
+        os.symlink('..', os.path.join(top.name, 'a/b/up'))
+        os.symlink('../a', os.path.join(top.name, 'c/toa'))
+        os.symlink('../a/f', os.path.join(top.name, 'c/lf'))
+        os.link(os.path.join(top.name, 'a/f'),
+                os.path.join(top.name, 'c/hard'))
+        for args in [['-r', 'hello', top.name], ['-R', 'hello', top.name],
+                     ['-r', 'hello', os.path.join(top.name, 'c/toa')],
+                     ['-Rc', 'hello', top.name]]:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            app.run(args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', args)
+            assert read_data == correct_data
+        self.setup_method()
+        app = Grep(output_file=self.ofile)
+        app.run(['-Rl', '--skip-duplicates', 'hello', top.name])
+        read_data = self.get_result().splitlines()
+        assert len(read_data) == 3
+        top.cleanup()
+
+    def test_index(self):
+        """ --index option """
+        top = TemporaryDirectory()
+        index = TemporaryDirectory()
+        texts = ['God created\n', 'the heaven and the earth\n',
+                 'darkness upon the face of the deep\n', 'light\n']
+        for n, text in enumerate(texts):
+            with open(os.path.join(top.name, str(n)), 'w') as f:
+                f.write(text * (n + 1))
+        args_list = [['-R', 'the'], ['-R', 'EARTH|deep'], ['-Rci', 'DEEP'],
+                     ['-Rn', 'light'], ['-Rv', 'the'], ['-Rl', 'hea.en']]
+        for args in args_list * 2:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            app.run(['--index', index.name] + args + [top.name])
+            read_data = sorted(self.get_result().splitlines())
+            correct_data = self.get_correct_data('grep', ['-E'] + args +
+                                                 [top.name])
+            assert read_data == sorted(correct_data.splitlines())
+            # a change of the file updates the index
+            with open(os.path.join(top.name, '3'), 'a') as f:
+                f.write('the deep\n')
+        top.cleanup()
+        index.cleanup()
+
+    def test_index_decompress(self):
+        """ --index option, the decompressed data has signatures of its own """
+        top = TemporaryDirectory()
+        index = TemporaryDirectory()
+        name = os.path.join(top.name, 'z.gz')
+        with gzip.open(name, 'wb') as f:
+            f.write(b'God created the heaven\n')
+        for opts in [[], ['--decompress'], []]:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            app.run(['--index', index.name, '-Rl', 'heaven'] + opts +
+                    [top.name])
+            read_data = self.get_result().splitlines()
+            assert read_data == [name.encode()] * len(opts)
+        top.cleanup()
+        index.cleanup()
+
+    def test_cache(self):
+        """ --cache option, a file is searched again once it changes """
+        cache = TemporaryDirectory()
+        name = NamedTemporaryFile().name
+        with open(name, 'w') as f:
+            f.write(open(self.ifile_name).read())
+        for n in range(3):
+            for opts in ['-n', '-c', '-l', '-v']:
+                self.setup_method()
+                app = Grep(output_file=self.ofile)
+                args = [opts, 'God', name, self.ifile_name]
+                app.run(['--cache', cache.name, '--cache-size', '8k'] + args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', args)
+                assert read_data == correct_data
+            with open(name, 'a') as f:
+                f.write('God saw it\n')
+        os.unlink(name)
+        cache.cleanup()
+
+    def test_cache_parallel(self):
+        """ --cache option with -j and --async-reads """
+        name = NamedTemporaryFile().name
+        with open(name, 'w') as f:
+            f.write(open(self.ifile_name).read())
+        for mode in [['-j2', '--keep-order'], ['--async-reads', '2']]:
+            cache = TemporaryDirectory()
+            for n in range(3):
+                self.setup_method()
+                app = Grep(output_file=self.ofile)
+                args = ['-n', 'God', name, self.ifile_name]
+                app.run(['--cache', cache.name] + mode + args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', args)
+                assert read_data == correct_data
+                db = sqlite3.connect(os.path.join(cache.name, 'results.db'))
+                count = db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+                db.close()
+                assert count == 2 + n
+                with open(name, 'a') as f:
+                    f.write('God saw it\n')
+            cache.cleanup()
+        os.unlink(name)
+
+    def test_cache_spill(self):
+        """ --cache option, an output larger than the cache is written
+        as it comes and not kept, a larger file is not cached at all """
+        cache = TemporaryDirectory()
+        size = os.path.getsize(self.ifile_name)
+        for limit, opts, kept in [(size + 40, '-n', 0), (size + 40, '-c', 1),
+                                  (size - 100, '-c', 0)]:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = [opts, 'e', self.ifile_name]
+            app.run(['--cache', cache.name, '--cache-size', str(limit)] + args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', args)
+            assert read_data == correct_data
+            db = sqlite3.connect(os.path.join(cache.name, 'results.db'))
+            assert db.execute('SELECT COUNT(*) FROM results').fetchone()[0] == kept
+            db.execute('DELETE FROM results')
+            db.commit()
+            db.close()
+        cache.cleanup()
+
+    def test_cache_evict(self):
+        """ --cache option, the least recently used entries are evicted
+        down to the low water mark, a batch at a time """
+        cache = TemporaryDirectory()
+        results = ResultCache(cache.name, 1000)
+        results.batch = 1
+        keys = ['%040d' % n for n in range(11)]
+        for key in keys[:10]:
+            results.put(key, True, b'x' * 60)
+        results.get(keys[0])
+        results.put(keys[10], True, b'x' * 60)
+        kept = [row[0] for row in results.db.execute(
+                'SELECT key FROM results ORDER BY key')]
+        assert kept == keys[:1] + keys[3:]
+        assert results.total == results.total_size() <= 900
+        results.close()
+        cache.cleanup()
+
+    def test_jobs(self):
+        """ -j option """
+        app = Grep(output_file=self.ofile)
+        args = ['-R', '-j', '4', 'colemak', '/usr/share/X11/xkb']
+        app.run(args)
+        read_data = sorted(self.get_result())
+        correct_data = sorted(self.get_correct_data('grep', args[:1] + args[3:]))
+        assert read_data == correct_data
+
+    def test_jobs_keep_order(self):
+        """ -j with --keep-order options, the names sent in batches """
+        names = ([self.ifile_name] * 5 + ['/not-exist', self.ifile_name]) * 20
+        for opts in ['-n', '-c', '-l', '-q']:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            args = ['-j3', '--keep-order', opts, 'water'] + names
+            status = app.run(args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', [opts, 'water'] + names)
+            assert read_data == correct_data
+            code = 0 if status else 1
+            correct_code = self.get_code('grep', [opts, 'water'] + names)
+            assert code == min(correct_code, 1)
+
+    def test_async_reads(self):
+        """ --async-reads option, the output in the order of the files """
+        names = [self.ifile_name] * 5 + ['/not-exist', self.ifile_name]
+        for limit in [100, 1 << 16]:
+            for opts in ['-n', '-c', '-l', '-q']:
+                self.setup_method()
+                app = Grep(output_file=self.ofile)
+                app.async_read_limit = limit
+                args = ['--async-reads', '3', opts, 'water'] + names
+                status = app.run(args)
+                read_data = self.get_result()
+                correct_data = self.get_correct_data('grep', args[2:])
+                assert read_data == correct_data
+                code = 0 if status else 1
+                correct_code = self.get_code('grep', args[2:])
+                assert code == min(correct_code, 1)
+
+    def test_segments(self):
+        """ -j option, a file searched in segments """
+        for opts in [['-n'], ['-c'], ['-l'], ['-L'], ['-q'], ['-vn'],
+                     ['-bn'], ['-on'], ['-n', '-m', '3'], ['-v', '-m', '7'],
+                     ['-c', '-m', '5'], ['-in']]:
+            self.setup_method()
+            app = Grep(output_file=self.ofile)
+            app.segment_min, app.segment_max = 64, 256
+            args = opts + ['the', self.ifile_name]
+            status = app.run(['-j', '3'] + args)
+            read_data = self.get_result()
+            correct_data = self.get_correct_data('grep', args)
+            assert read_data == correct_data
+            code = 0 if status else 1
+            assert code == self.get_code('grep', args)
+
     def test_exit_status(self):
         args_list = []
-        for o in list('ilncowHhqv'):
+        for o in list('ilLncowHhqv'):
             args = ['-'+o, 'God', self.ifile_name]
             args_list.append(args)
 